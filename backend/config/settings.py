@@ -108,6 +108,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # CORS Configuration
 _cors_allowed = os.getenv("CORS_ALLOWED_ORIGINS", "http://localhost:5173")
 CORS_ALLOWED_ORIGINS = [o.strip() for o in _cors_allowed.split(",") if o.strip()]
+CORS_EXPOSE_HEADERS = ["X-Cache", "Age"]
 
 # rest framework settings
 REST_FRAMEWORK = {
@@ -120,12 +121,108 @@ REDIS_URL = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/1")
 SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY", "")
 ALERTS_FROM_EMAIL = os.getenv("ALERTS_FROM_EMAIL", "")
 ALERTS_MIN_INTERVAL_MINUTES = int(os.getenv("ALERTS_MIN_INTERVAL_MINUTES", "30"))
+ALERTS_SHARD_LEASE_SECONDS = int(os.getenv("ALERTS_SHARD_LEASE_SECONDS", "60"))
+ALERTS_SEND_LEASE_SECONDS = int(os.getenv("ALERTS_SEND_LEASE_SECONDS", "120"))
+ALERTS_CHANGE_SKEW_SECONDS = int(os.getenv("ALERTS_CHANGE_SKEW_SECONDS", "300"))
 NEWS_API_KEY = os.getenv("NEWS_API_KEY", "")
 NEWS_QUERY = os.getenv("NEWS_QUERY", "weather OR climate OR storm OR wildfire")
 NEWS_PAGE_SIZE = int(os.getenv("NEWS_PAGE_SIZE", "8"))
 GOOGLE_CLIENT_ID = os.getenv("CLIENT_ID_GOOGLE", os.getenv("GOOGLE_CLIENT_ID", ""))
 GOOGLE_CLIENT_SECRET = os.getenv("CLIENT_SECRET_GOOGLE", os.getenv("GOOGLE_CLIENT_SECRET", ""))
 
+# Upstream HTTP client (pooled keep-alive sessions, see weather/upstream.py)
+UPSTREAM_POOL_CONNECTIONS = int(os.getenv("UPSTREAM_POOL_CONNECTIONS", "10"))
+UPSTREAM_POOL_MAXSIZE = int(os.getenv("UPSTREAM_POOL_MAXSIZE", "20"))
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))
+UPSTREAM_BACKOFF_FACTOR = float(os.getenv("UPSTREAM_BACKOFF_FACTOR", "0.3"))
+UPSTREAM_BACKOFF_JITTER = float(os.getenv("UPSTREAM_BACKOFF_JITTER", "0.3"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "3.05"))
+UPSTREAM_DEFAULT_TIMEOUT = float(os.getenv("UPSTREAM_DEFAULT_TIMEOUT", "10"))
+UPSTREAM_TIMEOUTS = {
+    "open_meteo": float(os.getenv("UPSTREAM_TIMEOUT_OPEN_METEO", "8")),
+    "nominatim": float(os.getenv("UPSTREAM_TIMEOUT_NOMINATIM", "6")),
+    "google": float(os.getenv("UPSTREAM_TIMEOUT_GOOGLE", "5")),
+    "newsapi": float(os.getenv("UPSTREAM_TIMEOUT_NEWSAPI", "8")),
+}
+
+
+# Shared per-provider rate budgets as "calls/seconds" (token buckets; every
+# retry is charged too) and circuit breaker thresholds (see
+# weather/throttle.py). Nominatim asks for at most 1 req/s;
+# the Open-Meteo and NewsAPI defaults follow their free tiers.
+def _rate_limit(name: str, default: str):
+    count, _, seconds = os.getenv(name, default).partition("/")
+    return int(count), float(seconds or 1)
+
+UPSTREAM_RATE_LIMITS = {
+    "open_meteo": _rate_limit("UPSTREAM_RATE_OPEN_METEO", "600/60"),
+    "nominatim": _rate_limit("UPSTREAM_RATE_NOMINATIM", "1/1"),
+    "google": _rate_limit("UPSTREAM_RATE_GOOGLE", "20/1"),
+    "newsapi": _rate_limit("UPSTREAM_RATE_NEWSAPI", "100/86400"),
+}
+UPSTREAM_RATE_WAIT_SECONDS = float(os.getenv("UPSTREAM_RATE_WAIT_SECONDS", "1"))
+UPSTREAM_BREAKER_FAILURES = int(os.getenv("UPSTREAM_BREAKER_FAILURES", "5"))
+UPSTREAM_BREAKER_WINDOW_SECONDS = int(os.getenv("UPSTREAM_BREAKER_WINDOW_SECONDS", "30"))
+UPSTREAM_BREAKER_OPEN_SECONDS = int(os.getenv("UPSTREAM_BREAKER_OPEN_SECONDS", "30"))
+
+# Adaptive cap on concurrent cache refetches per process (see
+# weather/admission.py). Over the cap, requests get a stale value or a 503.
+ADMISSION_INITIAL_LIMIT = int(os.getenv("ADMISSION_INITIAL_LIMIT", "20"))
+ADMISSION_MIN_LIMIT = int(os.getenv("ADMISSION_MIN_LIMIT", "2"))
+ADMISSION_MAX_LIMIT = int(os.getenv("ADMISSION_MAX_LIMIT", "200"))
+ADMISSION_TARGET_LATENCY_SECONDS = float(os.getenv("ADMISSION_TARGET_LATENCY_SECONDS", "2"))
+ADMISSION_BACKOFF = float(os.getenv("ADMISSION_BACKOFF", "0.8"))
+
+# Single-flight refetch on cache misses (see weather/caching.py). The lock is
+# renewed every third of its lifetime while the refetch runs, so it only
+# needs to outlive a crashed leader briefly, not the slowest upstream call.
+SINGLE_FLIGHT_LOCK_SECONDS = int(os.getenv("SINGLE_FLIGHT_LOCK_SECONDS", "20"))
+SINGLE_FLIGHT_WAIT_SECONDS = float(os.getenv("SINGLE_FLIGHT_WAIT_SECONDS", "12"))
+SINGLE_FLIGHT_POLL_SECONDS = float(os.getenv("SINGLE_FLIGHT_POLL_SECONDS", "0.05"))
+
+# Stale-while-revalidate: how long past its TTL a cached payload is still
+# served while refreshing, and how long the last good value is kept for
+# upstream outages.
+CACHE_STALE_GRACE_SECONDS = int(os.getenv("CACHE_STALE_GRACE_SECONDS", "1800"))
+CACHE_LAST_GOOD_SECONDS = int(os.getenv("CACHE_LAST_GOOD_SECONDS", "86400"))
+
+# Encoding for cached forecast/AQI payloads: "compact" (packed, zlib'd columns) or "none".
+CACHE_CODEC = os.getenv("CACHE_CODEC", "compact")
+
+# Serve /api/weather, /api/aqi and /api/alerts from cached, pre-compressed
+# JSON bytes. The cached/age/stale fields then move to the X-Cache and Age
+# headers so the body only depends on the content.
+PRERENDERED_RESPONSES = os.getenv("PRERENDERED_RESPONSES", "1") == "1"
+
+# In-process tier in front of Redis for hot keys (weather/caching.py). Short
+# lifetimes keep every worker within a few seconds of Redis.
+LOCAL_CACHE_SECONDS = float(os.getenv("LOCAL_CACHE_SECONDS", "5"))
+LOCAL_CACHE_MAX_ENTRIES = int(os.getenv("LOCAL_CACHE_MAX_ENTRIES", "2000"))
+LOCAL_CACHE_MAX_BYTES = int(os.getenv("LOCAL_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Spatial cache cells in degrees, per provider (see weather/cache_keys.py).
+# 0.02 deg is ~2 km, under Open-Meteo's forecast grid; air quality is coarser.
+CACHE_GRID_DEGREES = {
+    "forecast": float(os.getenv("CACHE_GRID_FORECAST_DEGREES", "0.02")),
+    "aqi": float(os.getenv("CACHE_GRID_AQI_DEGREES", "0.1")),
+    "location": float(os.getenv("CACHE_GRID_LOCATION_DEGREES", "0.01")),
+}
+
+# Geocoding cache: found results, "not found" results, and whether entries
+# are also persisted to the GeocodeResult table.
+GEOCODE_CACHE_TTL = int(os.getenv("GEOCODE_CACHE_TTL", str(30 * 24 * 3600)))
+GEOCODE_MISS_TTL = int(os.getenv("GEOCODE_MISS_TTL", str(24 * 3600)))
+GEOCODE_DB_CACHE = os.getenv("GEOCODE_DB_CACHE", "1") == "1"
+
+# Max coordinates per multi-location Open-Meteo forecast request.
+FORECAST_BATCH_SIZE = int(os.getenv("FORECAST_BATCH_SIZE", "50"))
+# Max coordinates per multi-location Open-Meteo air quality request.
+AQI_BATCH_SIZE = int(os.getenv("AQI_BATCH_SIZE", "50"))
+
+# Location autocomplete (/api/suggest). The gazetteer is optional.
+SUGGEST_GAZETTEER_PATH = os.getenv("SUGGEST_GAZETTEER_PATH", str(BASE_DIR / "weather" / "data" / "gazetteer.csv"))
+SUGGEST_REFRESH_SECONDS = int(os.getenv("SUGGEST_REFRESH_SECONDS", "300"))
+
 # Redis Cache Configuration
 CACHES = {
     "default": {
@@ -0,0 +1,77 @@
+import math
+import threading
+import time
+
+from django.conf import settings
+
+
+class Overloaded(Exception):
+    """The process is at its concurrency limit for upstream-bound work."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Too many upstream requests in flight, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class AdaptiveLimiter:
+    """
+    Caps concurrent upstream-bound work in this process, with the cap adjusted
+    AIMD style from how that work completes: each call finishing within
+    `target` seconds adds about one slot per cap's worth of calls, while a
+    slow or failed one cuts the cap by `backoff`, at most once per observed
+    latency so a burst of slow calls counts as one signal. Callers over the
+    cap are refused rather than queued.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int, target: float, backoff: float):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = target
+        self.backoff = backoff
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.in_flight = 0
+        self.latency = None
+        self.shed = 0
+        self._decreased_at = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        with self._lock:
+            if self.in_flight >= int(self.limit):
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency: float, ok: bool):
+        now = time.monotonic()
+        with self._lock:
+            self.in_flight -= 1
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            if ok and latency <= self.target:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif now - self._decreased_at >= latency:
+                self.limit = max(self.minimum, self.limit * self.backoff)
+                self._decreased_at = now
+
+    def retry_after(self) -> int:
+        """Seconds a refused caller should wait: about one upstream round trip."""
+        return max(1, math.ceil(self.latency or self.target))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "latency": self.latency,
+                "shed": self.shed,
+            }
+
+
+limiter = AdaptiveLimiter(
+    settings.ADMISSION_INITIAL_LIMIT,
+    settings.ADMISSION_MIN_LIMIT,
+    settings.ADMISSION_MAX_LIMIT,
+    settings.ADMISSION_TARGET_LATENCY_SECONDS,
+    settings.ADMISSION_BACKOFF,
+)
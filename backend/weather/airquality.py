@@ -0,0 +1,32 @@
+from django.conf import settings
+
+from .cache_keys import AQI, aqi_key, snap
+from .caching import aget_or_fill, get_or_fill_many
+from .services import afetch_aqi, fetch_aqis
+
+AQI_TTL = 900  # 15 minutes
+
+
+def aqi_entry(aqi) -> dict:
+    """The canonical cached AQI reading for one location."""
+    return {"aqi": aqi}
+
+
+async def aget_aqi(lat: float, lon: float, timezone: str = "auto", decode: bool = True):
+    """(entry, meta) for the snapped AQI cell, as served by /api/aqi; see aget_or_fill for `decode`."""
+    lat, lon = snap(lat, lon, AQI)
+
+    async def fill():
+        return aqi_entry(await afetch_aqi(lat, lon, timezone))
+
+    return await aget_or_fill(aqi_key(lat, lon, timezone), fill, AQI_TTL, decode)
+
+
+def get_aqis(locations, refresh_within: float = 0):
+    """
+    Bulk counterpart of aget_aqi for (lat, lon, timezone) triples: see
+    caching.get_or_fill_many. Missing entries are fetched in chunks of
+    AQI_BATCH_SIZE.
+    """
+    cells = [(*snap(lat, lon, AQI), timezone) for lat, lon, timezone in locations]
+    return get_or_fill_many(cells, aqi_key, fetch_aqis, aqi_entry, AQI_TTL, settings.AQI_BATCH_SIZE, refresh_within)
@@ -1,122 +1,197 @@
-def build_alerts(forecast: dict) -> list[dict]:
+import operator
+
+# Declarative alert rules, evaluated in this order. Each rule reads one metric
+# from the "current", "hourly" or "daily" block of a forecast, reduces the
+# first `window` values with `aggregate`, and fires the first level whose
+# threshold passes `op`. Levels are listed most severe first. Detail strings
+# can use {value}, {rounded} and, for "first_match", {time}.
+#
+# Aggregates:
+#   value        the scalar itself (current block)
+#   first        the first value of the window
+#   max / min    over the window, ignoring nulls
+#   first_match  the first value in the window that passes the threshold
+#
+# A windowed rule only applies when the series (and, for hourly rules, the
+# time axis) has at least `window` values.
+RULES = [
+    {
+        "id": "rain",
+        "type": "rain",
+        "source": "daily",
+        "metric": "precipitation_probability_max",
+        "window": 1,
+        "aggregate": "first",
+        "op": ">=",
+        "levels": [
+            {"severity": "warning", "threshold": 80, "title": "Rain very likely today", "detail": "Chance of precipitation is {value}%."},
+            {"severity": "info", "threshold": 60, "title": "Rain possible today", "detail": "Chance of precipitation is {value}%."},
+        ],
+    },
+    {
+        "id": "wind",
+        "type": "wind",
+        "source": "current",
+        "metric": "wind_speed_10m",
+        "aggregate": "value",
+        "op": ">=",
+        "levels": [
+            {"severity": "warning", "threshold": 45, "title": "Strong winds", "detail": "Current wind speed is ~{rounded} km/h."},
+            {"severity": "info", "threshold": 30, "title": "Breezy conditions", "detail": "Current wind speed is ~{rounded} km/h."},
+        ],
+    },
+    {
+        "id": "uv",
+        "type": "uv",
+        "source": "current",
+        "metric": "uv_index",
+        "aggregate": "value",
+        "op": ">=",
+        "levels": [
+            {"severity": "warning", "threshold": 8, "title": "High UV", "detail": "UV index is {value}. Consider sunscreen and shade."},
+            {"severity": "info", "threshold": 6, "title": "Moderate/High UV", "detail": "UV index is {value}. Protection recommended."},
+        ],
+    },
+    {
+        "id": "freeze",
+        "type": "freeze",
+        "source": "daily",
+        "metric": "temperature_2m_min",
+        "window": 1,
+        "aggregate": "first",
+        "op": "<=",
+        "levels": [
+            {"severity": "warning", "threshold": -5, "title": "Freezing risk overnight", "detail": "Low is ~{rounded}°C."},
+            {"severity": "info", "threshold": 0, "title": "Near-freezing temperatures", "detail": "Low is ~{rounded}°C."},
+        ],
+    },
+    {
+        "id": "heat",
+        "type": "heat",
+        "source": "daily",
+        "metric": "temperature_2m_max",
+        "window": 1,
+        "aggregate": "first",
+        "op": ">=",
+        "levels": [
+            {"severity": "warning", "threshold": 32, "title": "Heat risk", "detail": "High is ~{rounded}°C. Stay hydrated."},
+            {"severity": "info", "threshold": 28, "title": "Warm day", "detail": "High is ~{rounded}°C."},
+        ],
+    },
+    {
+        "id": "rain_soon",
+        "type": "rain",
+        "source": "hourly",
+        "metric": "precipitation_probability",
+        "window": 12,
+        "aggregate": "first_match",
+        "op": ">=",
+        "levels": [
+            {"severity": "warning", "threshold": 70, "title": "Rain likely soon", "detail": "High precipitation probability around {time} ({value}%)."},
+        ],
+    },
+]
+
+OPERATORS = {">=": operator.ge, "<=": operator.le, ">": operator.gt, "<": operator.lt}
+AGGREGATES = {
+    "first": lambda values: values[0],
+    "max": lambda values: max((v for v in values if v is not None), default=None),
+    "min": lambda values: min((v for v in values if v is not None), default=None),
+}
+
+
+def _compile_rule(rule: dict):
+    source, metric = rule["source"], rule["metric"]
+    window = rule.get("window", 1)
+    aggregate = rule["aggregate"]
+    op = OPERATORS[rule["op"]]
+    levels = tuple(
+        (level["severity"], level["threshold"], level["title"], level["detail"])
+        for level in rule["levels"]
+    )
+
+    # Threshold-independent part: run once per forecast and kept on the view.
+    if aggregate == "value":
+        def extract(forecast):
+            return ((forecast or {}).get(source) or {}).get(metric)
+    elif aggregate == "first_match":
+        def extract(forecast):
+            block = (forecast or {}).get(source) or {}
+            values = block.get(metric) or []
+            times = block.get("time") or []
+            if len(values) < window or len(times) < window:
+                return None
+            return values[:window], times[:window]
+    else:
+        reduce = AGGREGATES[aggregate]
+
+        def extract(forecast):
+            values = ((forecast or {}).get(source) or {}).get(metric) or []
+            if len(values) < window:
+                return None
+            return reduce(values[:window])
+
+    def alert(severity, title, detail, value, time=None):
+        rounded = round(value) if isinstance(value, (int, float)) else value
+        return {
+            "type": rule["type"],
+            "severity": severity,
+            "title": title,
+            "detail": detail.format(value=value, rounded=rounded, time=time),
+        }
+
+    if aggregate == "first_match":
+        def evaluate(extracted, thresholds):
+            values, times = extracted
+            for severity, threshold, title, detail in levels:
+                threshold = thresholds.get(severity, threshold)
+                for i, value in enumerate(values):
+                    if op(value or 0, threshold):
+                        return alert(severity, title, detail, value, times[i].replace("T", " "))
+            return None
+    else:
+        def evaluate(extracted, thresholds):
+            for severity, threshold, title, detail in levels:
+                if op(extracted, thresholds.get(severity, threshold)):
+                    return alert(severity, title, detail, extracted)
+            return None
+
+    return rule["id"], extract, evaluate
+
+
+class AlertPlan:
+    """
+    RULES compiled into (extract, evaluate) pairs. `view()` does the per
+    forecast work once; `evaluate()` applies thresholds to a view, so every
+    subscription sharing a forecast reuses the same view.
+    """
+
+    def __init__(self, rules):
+        self.rule_ids = {rule["id"] for rule in rules}
+        self._compiled = [_compile_rule(rule) for rule in rules]
+
+    def view(self, forecast: dict) -> list:
+        return [extract(forecast) for _, extract, _ in self._compiled]
+
+    def evaluate(self, view: list, overrides: dict | None = None) -> list[dict]:
+        """`overrides` maps rule id -> {severity: threshold}, e.g. {"wind": {"warning": 50}}."""
+        overrides = overrides or {}
+        alerts = []
+        for (rule_id, _, evaluate), extracted in zip(self._compiled, view):
+            if extracted is None:
+                continue
+            found = evaluate(extracted, overrides.get(rule_id) or {})
+            if found is not None:
+                alerts.append(found)
+        return alerts
+
+
+PLAN = AlertPlan(RULES)
+
+
+def build_alerts(forecast: dict, overrides: dict | None = None) -> list[dict]:
     """
     Returns a list of alert objects:
       { "type": "rain"|"wind"|"uv"|"freeze"|"heat", "severity": "info"|"warning", "title": "...", "detail": "..." }
     """
-
-    alerts = []
-
-    current = (forecast or {}).get("current") or {}
-    hourly = (forecast or {}).get("hourly") or {}
-    daily = (forecast or {}).get("daily") or {}
-
-    # ---------- RAIN ----------
-    # Use daily precip probability max if available
-    pmax_list = daily.get("precipitation_probability_max") or []
-    if len(pmax_list) > 0:
-        today_pmax = pmax_list[0]
-        if today_pmax >= 80:
-            alerts.append({
-                "type": "rain",
-                "severity": "warning",
-                "title": "Rain very likely today",
-                "detail": f"Chance of precipitation is {today_pmax}%."
-            })
-        elif today_pmax >= 60:
-            alerts.append({
-                "type": "rain",
-                "severity": "info",
-                "title": "Rain possible today",
-                "detail": f"Chance of precipitation is {today_pmax}%."
-            })
-
-    # ---------- WIND ----------
-    wind = current.get("wind_speed_10m")
-    if wind is not None:
-        if wind >= 45:
-            alerts.append({
-                "type": "wind",
-                "severity": "warning",
-                "title": "Strong winds",
-                "detail": f"Current wind speed is ~{round(wind)} km/h."
-            })
-        elif wind >= 30:
-            alerts.append({
-                "type": "wind",
-                "severity": "info",
-                "title": "Breezy conditions",
-                "detail": f"Current wind speed is ~{round(wind)} km/h."
-            })
-
-    # ---------- UV ----------
-    uv = current.get("uv_index")
-    if uv is not None:
-        if uv >= 8:
-            alerts.append({
-                "type": "uv",
-                "severity": "warning",
-                "title": "High UV",
-                "detail": f"UV index is {uv}. Consider sunscreen and shade."
-            })
-        elif uv >= 6:
-            alerts.append({
-                "type": "uv",
-                "severity": "info",
-                "title": "Moderate/High UV",
-                "detail": f"UV index is {uv}. Protection recommended."
-            })
-
-    # ---------- FREEZE ----------
-    tmin_list = daily.get("temperature_2m_min") or []
-    if len(tmin_list) > 0:
-        tonight_min = tmin_list[0]
-        if tonight_min <= -5:
-            alerts.append({
-                "type": "freeze",
-                "severity": "warning",
-                "title": "Freezing risk overnight",
-                "detail": f"Low is ~{round(tonight_min)}°C."
-            })
-        elif tonight_min <= 0:
-            alerts.append({
-                "type": "freeze",
-                "severity": "info",
-                "title": "Near-freezing temperatures",
-                "detail": f"Low is ~{round(tonight_min)}°C."
-            })
-
-    # ---------- HEAT ----------
-    tmax_list = daily.get("temperature_2m_max") or []
-    if len(tmax_list) > 0:
-        today_max = tmax_list[0]
-        if today_max >= 32:
-            alerts.append({
-                "type": "heat",
-                "severity": "warning",
-                "title": "Heat risk",
-                "detail": f"High is ~{round(today_max)}°C. Stay hydrated."
-            })
-        elif today_max >= 28:
-            alerts.append({
-                "type": "heat",
-                "severity": "info",
-                "title": "Warm day",
-                "detail": f"High is ~{round(today_max)}°C."
-            })
-
-    # ---------- HOURLY HEAVY RAIN WINDOW ----------
-    # Find any hour in next 12 with precip probability >= 70
-    h_probs = hourly.get("precipitation_probability") or []
-    h_times = hourly.get("time") or []
-    if len(h_probs) >= 12 and len(h_times) >= 12:
-        for i in range(12):
-            if (h_probs[i] or 0) >= 70:
-                alerts.append({
-                    "type": "rain",
-                    "severity": "warning",
-                    "title": "Rain likely soon",
-                    "detail": f"High precipitation probability around {h_times[i].replace('T',' ')} ({h_probs[i]}%)."
-                })
-                break
-
-    return alerts
+    return PLAN.evaluate(PLAN.view(forecast), overrides)
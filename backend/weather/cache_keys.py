@@ -1,13 +1,48 @@
 import hashlib
 
+from django.conf import settings
+
+FORECAST = "forecast"
+AQI = "aqi"
+LOCATION = "location"
+
+SUBSCRIPTIONS_VERSION_KEY = "wp:alertsubs:version"
+
 def _hash(s: str) -> str:
     return hashlib.sha256(s.encode("utf-8")).hexdigest()[:16]
 
-def weather_key(city: str) -> str:
-    return f"wp:weather:{_hash(city.strip().lower())}"
+def snap(lat: float, lon: float, grid: str):
+    """
+    Snap coordinates to the centre of a fixed lat/lon cell. Cell size is set
+    per provider in CACHE_GRID_DEGREES, roughly matching the upstream model
+    grid, so nearby requests share one cache entry and one upstream call.
+    """
+    step = settings.CACHE_GRID_DEGREES[grid]
+    return round(round(lat / step) * step, 4), round(round(lon / step) * step, 4)
+
+def geocode_key(kind: str, query: str) -> str:
+    return f"wp:geo:{kind}:{_hash(query)}"
+
+def forecast_key(lat: float, lon: float, timezone: str, variant: str = "") -> str:
+    lat, lon = snap(lat, lon, FORECAST)
+    key = f"wp:forecast:{lat:.4f}:{lon:.4f}:{timezone}"
+    return f"{key}:{variant}" if variant else key
 
 def aqi_key(lat: float, lon: float, timezone: str) -> str:
+    lat, lon = snap(lat, lon, AQI)
     return f"wp:aqi:{lat:.4f}:{lon:.4f}:{timezone}"
 
-def alerts_key(lat: float, lon: float, timezone: str) -> str:
-    return f"wp:alerts:{lat:.4f}:{lon:.4f}:{timezone}"
+def body_key(etag: str) -> str:
+    return f"wp:body:{_hash(etag)}"
+
+def rate_key(provider: str) -> str:
+    return f"wp:rate:{provider}"
+
+def breaker_key(provider: str, part: str) -> str:
+    return f"wp:breaker:{provider}:{part}"
+
+def shard_lease_key(shard: int, total: int) -> str:
+    return f"wp:lease:shard:{shard}/{total}"
+
+def send_lease_key(subscription_id: int) -> str:
+    return f"wp:lease:alertsub:{subscription_id}"
@@ -0,0 +1,426 @@
+import asyncio
+import contextvars
+import functools
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+
+from . import admission, codec
+from .local_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Refreshes scheduled after serving a stale value run on their own loop in a
+# daemon thread, so they outlive the request (and its loop under WSGI).
+_refresh_loop = None
+_refresh_lock = threading.Lock()
+
+
+# Tier 1: a small per-process LRU in front of Redis (tier 2) for hot keys.
+# Entries live at most LOCAL_CACHE_SECONDS, and envelopes only while fresh,
+# so a value refreshed by another worker is picked up within that window.
+# Envelopes are kept packed, as stored: a hit served from a pre-rendered body
+# never needs the payload, so it is only decoded when something reads it.
+_local = LRUCache(settings.LOCAL_CACHE_MAX_ENTRIES, settings.LOCAL_CACHE_MAX_BYTES)
+_counters = {"local_hits": 0, "local_misses": 0, "redis_hits": 0, "redis_misses": 0}
+_counters_lock = threading.Lock()
+
+
+def _count(name: str, n: int = 1):
+    with _counters_lock:
+        _counters[name] += n
+
+
+def tier_stats() -> dict:
+    with _counters_lock:
+        counters = dict(_counters)
+    return {
+        "local": {
+            "hits": counters["local_hits"],
+            "misses": counters["local_misses"],
+            "entries": len(_local),
+            "bytes": _local.size_bytes,
+            "evictions": _local.evictions,
+        },
+        "redis": {"hits": counters["redis_hits"], "misses": counters["redis_misses"]},
+    }
+
+
+def _remember(key: str, value, timeout=None):
+    ttl = settings.LOCAL_CACHE_SECONDS
+    if timeout is not None:
+        ttl = min(ttl, timeout)
+    if is_envelope(value):
+        ttl = min(ttl, value["soft_until"] - time.time())
+    _local.set(key, value, ttl)
+
+
+def _local_read(key: str):
+    hit, value = _local.get(key)
+    _count("local_hits" if hit else "local_misses")
+    return hit, value
+
+
+def read(key: str):
+    """cache.get through the in-process tier."""
+    hit, value = _local_read(key)
+    if hit:
+        return value
+    value = cache.get(key)
+    _count("redis_misses" if value is None else "redis_hits")
+    if value is not None:
+        _remember(key, value)
+    return value
+
+
+async def aread(key: str):
+    hit, value = _local_read(key)
+    if hit:
+        return value
+    value = await cache.aget(key)
+    _count("redis_misses" if value is None else "redis_hits")
+    if value is not None:
+        _remember(key, value)
+    return value
+
+
+def read_many(keys) -> dict:
+    """cache.get_many through the in-process tier; only local misses go to Redis."""
+    found, missing = {}, []
+    for key in keys:
+        hit, value = _local_read(key)
+        if hit:
+            found[key] = value
+        else:
+            missing.append(key)
+    if missing:
+        fetched = cache.get_many(missing)
+        _count("redis_hits", len(fetched))
+        _count("redis_misses", len(missing) - len(fetched))
+        for key, value in fetched.items():
+            _remember(key, value)
+        found.update(fetched)
+    return found
+
+
+def write(key: str, value, timeout):
+    cache.set(key, value, timeout=timeout)
+    _remember(key, value, timeout)
+
+
+async def awrite(key: str, value, timeout):
+    await cache.aset(key, value, timeout=timeout)
+    _remember(key, value, timeout)
+
+
+def write_many(values: dict, timeout):
+    cache.set_many(values, timeout=timeout)
+    for key, value in values.items():
+        _remember(key, value, timeout)
+
+
+def _lock_key(key: str) -> str:
+    return f"wp:lock:{key}"
+
+
+RESPONSE_FIELDS = ("cached", "age", "stale")
+
+
+def digest(payload) -> str:
+    body = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()[:32]
+
+
+def envelope(payload, ttl: int, fetched_at=None) -> dict:
+    """
+    Cached values are stored as {"payload", "digest", "fetched_at", "soft_until", "hard_until"}.
+    Before soft_until the payload is fresh; between soft_until and hard_until
+    it is served immediately while a refresh runs in the background; after
+    hard_until it is only served if refetching fails. The digest only changes
+    when the content does, so it doubles as an HTTP validator.
+    """
+    fetched_at = fetched_at or time.time()
+    return {
+        "payload": payload,
+        "digest": digest(payload),
+        "fetched_at": fetched_at,
+        "soft_until": fetched_at + ttl,
+        "hard_until": fetched_at + ttl + settings.CACHE_STALE_GRACE_SECONDS,
+    }
+
+
+def is_envelope(value) -> bool:
+    return isinstance(value, dict) and "payload" in value and "fetched_at" in value
+
+
+def storage_timeout(entry: dict) -> int:
+    # Keep the last good value around well past hard_until so it can still be
+    # served when the upstream is down.
+    return max(1, int(entry["hard_until"] - time.time()) + settings.CACHE_LAST_GOOD_SECONDS)
+
+
+def packed(entry: dict) -> dict:
+    """The envelope as stored: the payload goes through the cache codec."""
+    return {**entry, "payload": codec.pack(entry["payload"])}
+
+
+def payload(entry: dict, series: bool = True):
+    """
+    Decoded payload of a stored envelope. The envelope fields themselves are
+    never encoded, so freshness checks do not pay for decoding.
+    """
+    return codec.unpack(entry["payload"], series)
+
+
+def meta(entry: dict, cached: bool, stale: bool = False) -> dict:
+    """
+    RESPONSE_FIELDS for the response body, plus the entry's digest, fetch
+    time, remaining freshness (max_age) and full freshness lifetime
+    (lifetime, 0 once stale) for HTTP caching headers.
+    """
+    now = time.time()
+    return {
+        "cached": cached,
+        "age": max(0, int(now - entry["fetched_at"])),
+        "stale": stale,
+        "digest": entry.get("digest") or repr(entry["fetched_at"]),
+        "fetched_at": entry["fetched_at"],
+        "max_age": 0 if stale else max(0, int(entry["soft_until"] - now)),
+        "lifetime": 0 if stale else int(entry["soft_until"] - entry["fetched_at"]),
+    }
+
+
+def response_meta(info: dict) -> dict:
+    return {name: info[name] for name in RESPONSE_FIELDS}
+
+
+def response_headers(info: dict) -> dict:
+    """RESPONSE_FIELDS as headers, for bodies that leave them out."""
+    state = "STALE" if info["stale"] else "HIT" if info["cached"] else "MISS"
+    return {"X-Cache": state, "Age": str(info["age"])}
+
+
+async def _arelease(lock_key: str, token: str):
+    if await cache.aget(lock_key) == token:
+        await cache.adelete(lock_key)
+
+
+async def _aread(key: str):
+    entry = await aread(key)
+    return entry if is_envelope(entry) else None
+
+
+async def _afill_and_store(key: str, fill, ttl: int):
+    value = await fill()
+    if value is None:
+        return None
+    entry = envelope(value, ttl)
+    await awrite(key, packed(entry), storage_timeout(entry))
+    return entry
+
+
+async def _afill_admitted(key: str, fill, ttl: int):
+    """
+    _afill_and_store under the process's adaptive concurrency limit, so
+    upstream slowdowns cannot tie up every worker. Raises Overloaded at the
+    limit; callers holding a previous value serve that instead.
+    """
+    if not admission.limiter.acquire():
+        raise admission.Overloaded(admission.limiter.retry_after())
+    started = time.monotonic()
+    ok = False
+    try:
+        entry = await _afill_and_store(key, fill, ttl)
+        ok = True
+        return entry
+    finally:
+        admission.limiter.release(time.monotonic() - started, ok)
+
+
+async def _akeep_lock(lock_key: str, token: str):
+    # Renews the single-flight lock while its owner is still filling, so a
+    # slow upstream (timeouts plus retries) never lets a second leader in.
+    interval = settings.SINGLE_FLIGHT_LOCK_SECONDS / 3
+    while True:
+        await asyncio.sleep(interval)
+        if await cache.aget(lock_key) != token:
+            return
+        await cache.atouch(lock_key, settings.SINGLE_FLIGHT_LOCK_SECONDS)
+
+
+async def _afill_locked(key: str, fill, ttl: int, lock_key: str, token: str):
+    """_afill_admitted by the holder of `lock_key`, which is kept alive meanwhile and released after."""
+    keeper = asyncio.ensure_future(_akeep_lock(lock_key, token))
+    try:
+        return await _afill_admitted(key, fill, ttl)
+    finally:
+        keeper.cancel()
+        await _arelease(lock_key, token)
+
+
+def _background_loop():
+    global _refresh_loop
+    with _refresh_lock:
+        if _refresh_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="wp-cache-refresh", daemon=True).start()
+            _refresh_loop = loop
+    return _refresh_loop
+
+
+def _schedule_refresh(key: str, fill, ttl: int):
+    async def refresh():
+        lock_key = _lock_key(key)
+        token = uuid.uuid4().hex
+        if not await cache.aadd(lock_key, token, timeout=settings.SINGLE_FLIGHT_LOCK_SECONDS):
+            return
+        try:
+            await _afill_locked(key, fill, ttl, lock_key, token)
+        except Exception as exc:
+            logger.warning("Background refresh failed for %s: %s", key, exc)
+
+    # Submit from an empty context so the task does not inherit the request's
+    # asgiref executor, which is gone by the time the refresh runs.
+    contextvars.Context().run(asyncio.run_coroutine_threadsafe, refresh(), _background_loop())
+
+
+def _loaded(entry: dict, decode: bool):
+    return payload(entry) if decode else functools.partial(payload, entry)
+
+
+async def aget_or_fill(key: str, fill, ttl: int, decode: bool = True):
+    """
+    Read `key`, or compute it with `fill()` while making sure only one worker
+    in the cluster does so. Returns (payload, meta) where meta carries the
+    `cached`, `age` and `stale` response fields, or (None, None) when `fill()`
+    returns None (which is not cached). With decode=False the payload comes
+    back as a function that decodes it on demand (taking payload()'s
+    `series`), so callers that can answer from meta alone never pay for it.
+
+    The first caller to miss takes a short lock with cache.add (atomic SET NX
+    on Redis), renewed for as long as it refetches; everyone else polls the
+    cache until a newer value lands. If the leader fails and drops the lock,
+    the next waiter takes over. Whenever a refetch fails or waiting times out
+    and a previous value exists, that value is served with stale=True
+    instead. Refetches are admitted by admission.limiter. With no previous
+    value, being over its limit or waiting past SINGLE_FLIGHT_WAIT_SECONDS
+    raises admission.Overloaded (a 503 with Retry-After in the views).
+    """
+    current = await _aread(key)
+    now = time.time()
+    if current is not None:
+        if now < current["soft_until"]:
+            return _loaded(current, decode), meta(current, cached=True)
+        if now < current["hard_until"]:
+            _schedule_refresh(key, fill, ttl)
+            return _loaded(current, decode), meta(current, cached=True, stale=True)
+
+    lock_key = _lock_key(key)
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + settings.SINGLE_FLIGHT_WAIT_SECONDS
+    delay = settings.SINGLE_FLIGHT_POLL_SECONDS
+
+    while True:
+        if await cache.aadd(lock_key, token, timeout=settings.SINGLE_FLIGHT_LOCK_SECONDS):
+            try:
+                entry = await _afill_locked(key, fill, ttl, lock_key, token)
+            except Exception:
+                if current is None:
+                    raise
+                logger.warning("Refetch failed for %s, serving last good value", key)
+                return _loaded(current, decode), meta(current, cached=True, stale=True)
+            if entry is None:
+                return None, None
+            return _loaded(entry, decode), meta(entry, cached=False)
+
+        if time.monotonic() >= deadline:
+            # The leader is still at it: never pile onto a slow upstream
+            # without the lock.
+            if current is not None:
+                return _loaded(current, decode), meta(current, cached=True, stale=True)
+            raise admission.Overloaded(admission.limiter.retry_after())
+
+        await asyncio.sleep(delay)
+        delay = min(delay * 1.5, 0.25)
+
+        latest = await _aread(key)
+        if latest is not None and (current is None or latest["fetched_at"] > current["fetched_at"]):
+            return _loaded(latest, decode), meta(latest, cached=True)
+
+
+def get_or_fill_many(cells, key_for, fetch_many, build, ttl: int, batch_size: int, refresh_within: float = 0):
+    """
+    Bulk counterpart of aget_or_fill for snapped (lat, lon, timezone) cells.
+
+    All keys (`key_for(*cell)`) are read with one get_many. Anything missing
+    or past its soft TTL (or due to pass it within `refresh_within` seconds)
+    is refetched with `fetch_many(coordinates, timezone)`, one multi-coordinate
+    request per timezone in chunks of `batch_size`, wrapped with `build` and
+    written back with one set_many. Returns a list aligned with `cells` of
+    (payload, meta); a failed chunk falls back to the previous value, stale,
+    or (None, None) when nothing was cached.
+
+    Each chunk's request is admitted by admission.limiter like a single
+    refetch. A refused chunk is served stale as well, and if any of its
+    cells had nothing cached, admission.Overloaded is raised once the other
+    chunks are stored.
+    """
+    keys = {cell: key_for(*cell) for cell in cells}
+    cached = read_many(list(keys.values()))
+    now = time.time()
+
+    found = {}
+    previous = {}
+    pending = defaultdict(list)
+    for cell, key in keys.items():
+        entry = cached.get(key)
+        if is_envelope(entry):
+            if now + refresh_within < entry["soft_until"]:
+                found[cell] = (payload(entry), meta(entry, cached=True))
+                continue
+            previous[cell] = entry
+        pending[cell[2]].append(cell)
+
+    def serve_stale(chunk):
+        for cell in chunk:
+            if cell in previous:
+                found[cell] = (payload(previous[cell]), meta(previous[cell], cached=True, stale=True))
+
+    fresh = {}
+    overloaded = False
+    for timezone, group in pending.items():
+        for i in range(0, len(group), batch_size):
+            chunk = group[i:i + batch_size]
+            if not admission.limiter.acquire():
+                overloaded = overloaded or any(cell not in previous for cell in chunk)
+                serve_stale(chunk)
+                continue
+            started = time.monotonic()
+            ok = False
+            try:
+                results = fetch_many([(lat, lon) for lat, lon, _ in chunk], timezone)
+                ok = True
+            except requests.RequestException as exc:
+                logger.warning("%s failed for %d locations: %s", fetch_many.__name__, len(chunk), exc)
+                serve_stale(chunk)
+                continue
+            finally:
+                admission.limiter.release(time.monotonic() - started, ok)
+            for cell, result in zip(chunk, results):
+                entry = envelope(build(result), ttl)
+                fresh[keys[cell]] = packed(entry)
+                found[cell] = (entry["payload"], meta(entry, cached=False))
+
+    if fresh:
+        write_many(fresh, storage_timeout(next(iter(fresh.values()))))
+    if overloaded:
+        raise admission.Overloaded(admission.limiter.retry_after())
+    return [found.get(cell, (None, None)) for cell in cells]
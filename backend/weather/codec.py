@@ -0,0 +1,242 @@
+import functools
+import json
+import math
+import pickle
+import struct
+import threading
+import time
+import zlib
+from array import array
+from datetime import date, datetime, timedelta
+
+from django.conf import settings
+
+FORMAT = "wp-compact-1"
+ZLIB_LEVEL = 6
+MAX_DECIMALS = 3
+
+_stats = {
+    "encoded": 0,
+    "raw_bytes": 0,
+    "packed_bytes": 0,
+    "encode_seconds": 0.0,
+    "decoded": 0,
+    "decode_seconds": 0.0,
+}
+_stats_lock = threading.Lock()
+
+
+def _record(**deltas):
+    with _stats_lock:
+        for name, value in deltas.items():
+            _stats[name] += value
+
+
+def stats() -> dict:
+    """Per-process totals plus the derived compression ratio and mean timings."""
+    with _stats_lock:
+        snapshot = dict(_stats)
+    snapshot["ratio"] = snapshot["raw_bytes"] / snapshot["packed_bytes"] if snapshot["packed_bytes"] else None
+    snapshot["encode_ms"] = 1000 * snapshot["encode_seconds"] / snapshot["encoded"] if snapshot["encoded"] else None
+    snapshot["decode_ms"] = 1000 * snapshot["decode_seconds"] / snapshot["decoded"] if snapshot["decoded"] else None
+    return snapshot
+
+
+def is_packed(value) -> bool:
+    return isinstance(value, dict) and value.get("format") == FORMAT
+
+
+# ---------- columns ----------
+# A series block is a dict of equal-length lists with a "time" axis, like the
+# Open-Meteo "hourly" and "daily" blocks. Each list becomes one column:
+#   ["t", name, start, step_seconds]        evenly spaced ISO times
+#   ["a", name, typecode, decimals, nulls]  packed numbers: decimals 0 for ints,
+#                                           > 0 for floats stored as
+#                                           round(v * 10**decimals), -2 for
+#                                           whole floats, -1 for raw doubles
+#   ["j", name, values]                     anything else, kept as JSON
+
+def _time_column(name, values):
+    if not values or not all(isinstance(v, str) for v in values):
+        return None
+    kind = date if len(values[0]) == 10 else datetime
+    try:
+        start = kind.fromisoformat(values[0])
+        step = kind.fromisoformat(values[1]) - start if len(values) > 1 else timedelta(0)
+    except ValueError:
+        return None
+    if _expand_times(values[0], step.total_seconds(), len(values)) != values:
+        return None
+    return ["t", name, values[0], step.total_seconds()]
+
+
+def _expand_times(start, step_seconds, n):
+    return list(_time_axis(start, step_seconds, n))
+
+
+@functools.lru_cache(maxsize=1024)
+def _time_axis(start, step_seconds, n):
+    # Every cell in a timezone shares the same axes, so this rarely misses.
+    step = timedelta(seconds=step_seconds)
+    if len(start) == 10:
+        first = date.fromisoformat(start)
+        return tuple((first + i * step).isoformat() for i in range(n))
+    first = datetime.fromisoformat(start)
+    return tuple((first + i * step).isoformat(timespec="minutes") for i in range(n))
+
+
+def _decimals(values):
+    for decimals in range(MAX_DECIMALS + 1):
+        scale = 10 ** decimals
+        if all(round(v * scale) / scale == v for v in values):
+            return decimals
+    return None
+
+
+def _number_column(name, values):
+    present = [v for v in values if v is not None]
+    nulls = [i for i, v in enumerate(values) if v is None]
+    if any(isinstance(v, bool) or not isinstance(v, (int, float)) for v in present):
+        return None, None
+    if all(isinstance(v, int) for v in present):
+        decimals, ints = 0, [v or 0 for v in values]
+    elif all(isinstance(v, float) for v in present):
+        # Floats parsed from short decimal strings come back exactly from
+        # q / 10**d, so they are stored as small integers when possible.
+        decimals = _decimals(present) if all(math.isfinite(v) for v in present) else None
+        if decimals is None:
+            return ["a", name, "d", -1, nulls], array("d", [v if v is not None else 0.0 for v in values])
+        scale = 10 ** decimals
+        ints = [round(v * scale) if v is not None else 0 for v in values]
+        if not all(-2**31 <= v < 2**31 for v in ints):
+            return ["a", name, "d", -1, nulls], array("d", [v if v is not None else 0.0 for v in values])
+        decimals = decimals or -2  # float column with whole values
+    else:
+        return None, None
+    typecode = "i" if all(-2**31 <= v < 2**31 for v in ints) else "q"
+    return ["a", name, typecode, decimals, nulls], array(typecode, ints)
+
+
+def _pack_series(block: dict) -> bytes:
+    columns, blobs = [], []
+    for name, values in block.items():
+        column = _time_column(name, values) if name == "time" else None
+        blob = None
+        if column is None:
+            column, blob = _number_column(name, values)
+        if column is None:
+            column = ["j", name, values]
+        columns.append(column)
+        if blob is not None:
+            blobs.append(blob.tobytes())
+    header = json.dumps({"n": len(next(iter(block.values()))), "columns": columns}, separators=(",", ":")).encode("utf-8")
+    return zlib.compress(struct.pack("<I", len(header)) + header + b"".join(blobs), ZLIB_LEVEL)
+
+
+def _unpack_series(data: bytes) -> dict:
+    raw = zlib.decompress(data)
+    (size,) = struct.unpack_from("<I", raw)
+    header = json.loads(raw[4:4 + size])
+    n = header["n"]
+    offset = 4 + size
+    block = {}
+    for column in header["columns"]:
+        kind, name = column[0], column[1]
+        if kind == "t":
+            block[name] = _expand_times(column[2], column[3], n)
+        elif kind == "j":
+            block[name] = column[2]
+        else:
+            typecode, decimals, nulls = column[2], column[3], column[4]
+            packed = array(typecode)
+            size = n * packed.itemsize
+            packed.frombytes(raw[offset:offset + size])
+            offset += size
+            if decimals > 0:
+                scale = 10 ** decimals
+                values = [v / scale for v in packed]
+            elif decimals == -2:
+                values = [float(v) for v in packed]
+            else:
+                values = packed.tolist()
+            for i in nulls:
+                values[i] = None
+            block[name] = values
+    return block
+
+
+def _is_series(value) -> bool:
+    if not isinstance(value, dict) or not isinstance(value.get("time"), list) or len(value) < 2:
+        return False
+    n = len(value["time"])
+    return n > 1 and all(isinstance(v, list) and len(v) == n for v in value.values())
+
+
+def _split(value, path, series):
+    """
+    Copy of `value` with each series block packed into `series` by path and
+    replaced by a None placeholder, so key order survives the round trip.
+    """
+    if isinstance(value, dict):
+        skeleton = {}
+        for key, item in value.items():
+            if _is_series(item):
+                series[".".join((*path, key))] = _pack_series(item)
+                skeleton[key] = None
+            else:
+                skeleton[key] = _split(item, (*path, key), series)
+        return skeleton
+    return value
+
+
+# ---------- public API ----------
+
+def pack(payload, name=None):
+    """
+    Encode a cache payload with the codec `name` (default CACHE_CODEC). "compact"
+    returns {"format", "skeleton", "series"}: series blocks become packed,
+    zlib-compressed columns stored separately from the zlib'd JSON of
+    everything else. "none" (or an unencodable payload) returns it unchanged.
+    """
+    if (name or settings.CACHE_CODEC) != "compact" or not isinstance(payload, dict):
+        return payload
+    started = time.perf_counter()
+    series = {}
+    try:
+        skeleton = zlib.compress(
+            json.dumps(_split(payload, (), series), ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+            ZLIB_LEVEL,
+        )
+    except (TypeError, ValueError):
+        return payload
+    packed = {"format": FORMAT, "skeleton": skeleton, "series": series}
+    _record(
+        encoded=1,
+        encode_seconds=time.perf_counter() - started,
+        raw_bytes=len(pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)),
+        packed_bytes=len(skeleton) + sum(len(blob) for blob in series.values()),
+    )
+    return packed
+
+
+def unpack(value, series: bool = True):
+    """
+    Decode a value written by pack() (anything else is returned as is). With
+    series=False the hourly/daily style blocks are left out and never
+    decompressed, which is all callers that only need "current" pay for.
+    """
+    if not is_packed(value):
+        return value
+    started = time.perf_counter()
+    payload = json.loads(zlib.decompress(value["skeleton"]))
+    for path, data in value["series"].items():
+        *parents, key = path.split(".")
+        target = payload
+        for parent in parents:
+            target = target[parent]
+        if series:
+            target[key] = _unpack_series(data)
+        else:
+            del target[key]
+    _record(decoded=1, decode_seconds=time.perf_counter() - started)
+    return payload
@@ -0,0 +1,125 @@
+import time
+
+from django.conf import settings
+
+from .alerts import build_alerts
+from .cache_keys import FORECAST, forecast_key, snap
+from .caching import aget_or_fill, aread, get_or_fill_many, is_envelope
+from .services import FORECAST_VARIABLES, afetch_forecast, fetch_forecasts
+
+FORECAST_TTL = 600  # 10 minutes
+FORECAST_DAYS = 7  # Open-Meteo's default horizon, which the canonical entry uses
+
+
+def forecast_entry(forecast: dict) -> dict:
+    """
+    The canonical cached forecast for one location. build_alerts output is
+    memoized next to it so /api/alerts never refetches or recomputes it.
+    """
+    return {"forecast": forecast, "alerts": build_alerts(forecast)}
+
+
+def parse_projection(params):
+    """
+    Read `fields` (comma-separated blocks), `hours` and `days` from query
+    params. Returns None when none are given, otherwise a dict with the
+    requested blocks in canonical order. Raises ValueError on bad input.
+    """
+    if not any(params.get(name) for name in ("fields", "hours", "days")):
+        return None
+    fields = [f.strip() for f in (params.get("fields") or ",".join(FORECAST_VARIABLES)).split(",") if f.strip()]
+    unknown = [f for f in fields if f not in FORECAST_VARIABLES]
+    if unknown or not fields:
+        raise ValueError(f"fields must be a comma-separated subset of {', '.join(FORECAST_VARIABLES)}")
+    projection = {"fields": tuple(b for b in FORECAST_VARIABLES if b in fields), "hours": None, "days": None}
+    for name, limit in (("hours", FORECAST_DAYS * 24), ("days", FORECAST_DAYS)):
+        if params.get(name):
+            try:
+                projection[name] = int(params[name])
+            except ValueError:
+                projection[name] = 0
+            if not 1 <= projection[name] <= limit:
+                raise ValueError(f"{name} must be between 1 and {limit}")
+    return projection
+
+
+def project(forecast: dict, projection) -> dict:
+    """
+    Keep only the requested blocks (and their *_units), and the first `hours`
+    hourly / `days` daily values, counted from the start of each series.
+    """
+    if not projection:
+        return forecast
+    dropped = {b for b in FORECAST_VARIABLES if b not in projection["fields"]}
+    result = {k: v for k, v in forecast.items() if k.removesuffix("_units") not in dropped}
+    for block, limit in (("hourly", projection["hours"]), ("daily", projection["days"])):
+        if limit and isinstance(result.get(block), dict):
+            result[block] = {k: v[:limit] if isinstance(v, list) else v for k, v in result[block].items()}
+    return result
+
+
+def _projection_variant(projection) -> str:
+    return f"{'+'.join(projection['fields'])}:h{projection['hours'] or ''}:d{projection['days'] or ''}"
+
+
+def _projection_days(projection):
+    """Smallest forecast_days covering the projection; None means the default."""
+    days = 0
+    if "hourly" in projection["fields"]:
+        if not projection["hours"]:
+            return None
+        days = -(-projection["hours"] // 24)
+    if "daily" in projection["fields"]:
+        if not projection["days"]:
+            return None
+        days = max(days, projection["days"])
+    return max(days, 1)
+
+
+def _projected(entry: dict, projection) -> dict:
+    return {**entry, "forecast": project(entry["forecast"], projection)}
+
+
+async def aget_forecast(lat: float, lon: float, timezone: str = "auto", projection=None, decode: bool = True):
+    """
+    (entry, meta) for the snapped cell. With a projection, the forecast is
+    sliced from the canonical entry whenever that is cached (fresh or within
+    its stale grace). Only when nothing is cached is a narrower forecast
+    requested upstream, cached under its own key, and returned without alerts.
+    With decode=False the entry is a function, as from aget_or_fill.
+    """
+    lat, lon = snap(lat, lon, FORECAST)
+    key = forecast_key(lat, lon, timezone)
+
+    async def fill():
+        return forecast_entry(await afetch_forecast(lat, lon, timezone))
+
+    if projection:
+        current = await aread(key)
+        if not (is_envelope(current) and time.time() < current["hard_until"]):
+            async def fill_projected():
+                forecast = await afetch_forecast(lat, lon, timezone, projection["fields"], _projection_days(projection))
+                return {"forecast": project(forecast, projection)}
+
+            variant = forecast_key(lat, lon, timezone, _projection_variant(projection))
+            return await aget_or_fill(variant, fill_projected, FORECAST_TTL, decode)
+
+    entry, info = await aget_or_fill(key, fill, FORECAST_TTL, decode)
+    if projection and entry is not None:
+        if decode:
+            return _projected(entry, projection), info
+        load = entry
+        return (lambda: _projected(load(), projection)), info
+    return entry, info
+
+
+def get_forecasts(locations, refresh_within: float = 0):
+    """
+    Bulk counterpart of aget_forecast for (lat, lon, timezone) triples: see
+    caching.get_or_fill_many. Missing entries are fetched in chunks of
+    FORECAST_BATCH_SIZE.
+    """
+    cells = [(*snap(lat, lon, FORECAST), timezone) for lat, lon, timezone in locations]
+    return get_or_fill_many(
+        cells, forecast_key, fetch_forecasts, forecast_entry, FORECAST_TTL, settings.FORECAST_BATCH_SIZE, refresh_within
+    )
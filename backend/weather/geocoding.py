@@ -0,0 +1,84 @@
+import re
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import services
+from .cache_keys import LOCATION, geocode_key, snap
+from .caching import aread, awrite
+from .models import GeocodeResult
+
+CITY = "city"
+ADDRESS = "address"
+REVERSE = "reverse"
+
+
+def normalize_query(query: str) -> str:
+    query = re.sub(r"\s*,\s*", ", ", query.strip())
+    return " ".join(query.split()).casefold()
+
+
+def _ttl(result) -> int:
+    return settings.GEOCODE_CACHE_TTL if result is not None else settings.GEOCODE_MISS_TTL
+
+
+def _persisted(query: str) -> bool:
+    return settings.GEOCODE_DB_CACHE and len(query) <= 255
+
+
+async def _acached(kind: str, query: str, lookup):
+    """
+    Geocoding results barely change, so they are cached for GEOCODE_CACHE_TTL,
+    and lookups that found nothing are remembered for GEOCODE_MISS_TTL. With
+    GEOCODE_DB_CACHE on, entries are also written to GeocodeResult so they
+    survive a Redis flush. Upstream (HTTP) errors propagate and are never
+    cached; an unparseable response counts as no result.
+    """
+    key = geocode_key(kind, query)
+    hit = await aread(key)
+    if hit is not None:
+        return hit["result"]
+
+    if _persisted(query):
+        row = await GeocodeResult.objects.filter(kind=kind, query=query).afirst()
+        if row is not None:
+            remaining = _ttl(row.result) - (timezone.now() - row.fetched_at).total_seconds()
+            if remaining > 0:
+                await awrite(key, {"result": row.result}, int(remaining))
+                return row.result
+
+    try:
+        result = await lookup()
+    except (ValueError, KeyError, TypeError):
+        # A malformed upstream body means no usable result, not a server error.
+        # It is not cached either, so the next lookup tries again.
+        return None
+    await awrite(key, {"result": result}, _ttl(result))
+    if _persisted(query):
+        await GeocodeResult.objects.aupdate_or_create(
+            kind=kind,
+            query=query,
+            defaults={"result": result, "fetched_at": timezone.now()},
+        )
+    return result
+
+
+async def ageocode_city(city: str):
+    query = normalize_query(city)
+    return await _acached(CITY, query, lambda: services.ageocode_city(query))
+
+
+async def ageocode_address(address: str):
+    query = normalize_query(address)
+    return await _acached(ADDRESS, query, lambda: services.ageocode_address(query, raise_errors=True))
+
+
+async def areverse_geocode(lat: float, lon: float):
+    lat, lon = snap(lat, lon, LOCATION)
+    query = f"{lat:.4f},{lon:.4f}"
+    return await _acached(REVERSE, query, lambda: services.areverse_geocode(lat, lon, raise_errors=True))
+
+
+async def alocate(query: str):
+    """City name first, then a full address search through Nominatim."""
+    return await ageocode_city(query) or await ageocode_address(query)
@@ -0,0 +1,25 @@
+import os
+import socket
+import uuid
+
+from django.core.cache import cache
+
+
+def new_owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def acquire(key: str, owner: str, ttl: int) -> bool:
+    """Take the lease if nobody holds it (SET NX on Redis)."""
+    return cache.add(key, owner, timeout=ttl)
+
+
+def renew(key: str, owner: str, ttl: int) -> bool:
+    if cache.get(key) != owner:
+        return False
+    return cache.touch(key, ttl)
+
+
+def release(key: str, owner: str):
+    if cache.get(key) == owner:
+        cache.delete(key)
@@ -0,0 +1,72 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    In-process cache bounded by entry count and (pickled) bytes, evicting the
+    least recently used entries first. Every entry carries its own expiry.
+    Values are shared between callers and must be treated as read-only.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def get(self, key):
+        """Returns (hit, value)."""
+        now = time.monotonic()
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return False, None
+            value, expires_at, size = item
+            if now >= expires_at:
+                del self._entries[key]
+                self._bytes -= size
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, ttl: float):
+        if ttl <= 0 or self.max_entries <= 0:
+            self.delete(key)
+            return
+        size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes:
+            self.delete(key)
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (value, time.monotonic() + ttl, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
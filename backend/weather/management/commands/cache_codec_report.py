@@ -0,0 +1,43 @@
+from itertools import islice
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from weather import codec
+from weather.caching import is_envelope, payload
+
+
+class Command(BaseCommand):
+    help = "Sample cached forecast/AQI entries and report the cache codec's compression ratio and timings."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pattern", default="wp:*", help="Key pattern to sample.")
+        parser.add_argument("--sample", type=int, default=500, help="Maximum number of keys to read.")
+
+    def handle(self, *args, **options):
+        if not hasattr(cache, "iter_keys"):
+            self.stdout.write("The configured cache backend cannot list keys (django-redis is required).")
+            return
+
+        entries = 0
+        for key in islice(cache.iter_keys(options["pattern"]), options["sample"]):
+            entry = cache.get(key)
+            if not is_envelope(entry):
+                continue
+            entries += 1
+            # Decode what is stored, then re-encode it, so both directions are
+            # timed even when CACHE_CODEC is currently "none".
+            codec.pack(payload(entry), "compact")
+
+        if not entries:
+            self.stdout.write("No cached payloads matched.")
+            return
+
+        report = codec.stats()
+        self.stdout.write(
+            f"{entries} payloads: {report['raw_bytes']} bytes pickled -> {report['packed_bytes']} bytes packed "
+            f"(ratio {report['ratio']:.1f}x, {report['packed_bytes'] / entries:.0f} bytes/entry)"
+        )
+        self.stdout.write(f"encode {report['encode_ms']:.3f} ms/payload")
+        if report["decode_ms"] is not None:
+            self.stdout.write(f"decode {report['decode_ms']:.3f} ms/payload")
@@ -0,0 +1,96 @@
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from weather.airquality import get_aqis
+from weather.cache_keys import AQI, FORECAST, aqi_key, forecast_key, snap
+from weather.caching import is_envelope, read_many
+from weather.forecasts import get_forecasts
+from weather.models import AlertSubscription, SavedLocation
+
+KINDS = (
+    # (name, grid, cache key, bulk getter); the forecast entry carries the alerts.
+    ("forecast", FORECAST, forecast_key, get_forecasts),
+    ("aqi", AQI, aqi_key, get_aqis),
+)
+
+
+def popular_cells(grid: str, limit=None):
+    """
+    Distinct snapped (lat, lon, timezone) cells across saved locations and
+    alert subscriptions, most referenced first.
+    """
+    counts = Counter()
+    for model in (SavedLocation, AlertSubscription):
+        rows = model.objects.values("lat", "lon", "timezone").annotate(n=Count("id")).values_list("lat", "lon", "timezone", "n")
+        for lat, lon, timezone, n in rows.iterator():
+            counts[(*snap(lat, lon, grid), timezone or "auto")] += n
+    return [cell for cell, _ in counts.most_common(limit)]
+
+
+class Command(BaseCommand):
+    help = (
+        "Refresh cached forecast (with alerts) and AQI entries for every saved location and "
+        "alert subscription cell shortly before they expire, using batched upstream requests."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lead", type=float, default=60.0, help="Refresh entries this many seconds before they expire.")
+        parser.add_argument("--limit", type=int, default=None, help="Only warm the N most popular cells of each kind.")
+        parser.add_argument("--loop", action="store_true", help="Keep running, waking up as entries come due.")
+        parser.add_argument("--max-sleep", type=float, default=60.0, help="Loop: longest wait between passes.")
+
+    def warm(self, name, grid, key_for, get_many, lead, limit):
+        """One pass for one kind. Returns seconds until its next entry comes due."""
+        cells = popular_cells(grid, limit)
+        if not cells:
+            self.stdout.write(f"{name}: no cells")
+            return None
+
+        before = read_many([key_for(*cell) for cell in cells])
+        now = time.time()
+        entries = [before.get(key_for(*cell)) for cell in cells]
+        fresh = sum(1 for entry in entries if is_envelope(entry) and now < entry["soft_until"])
+        cold = sum(1 for entry in entries if not is_envelope(entry))
+
+        started = time.monotonic()
+        results = get_many(cells, refresh_within=lead)
+        elapsed = time.monotonic() - started
+
+        refreshed = failed = 0
+        lags = []
+        next_due = None
+        for entry, (_, info) in zip(entries, results):
+            if info is None or info["stale"]:
+                failed += 1
+                continue
+            if not info["cached"]:
+                refreshed += 1
+                if is_envelope(entry):
+                    lags.append(max(0.0, now - entry["soft_until"]))
+            due = info["max_age"] - lead
+            next_due = due if next_due is None else min(next_due, due)
+
+        lag = f"avg {sum(lags) / len(lags):.1f}s, max {max(lags):.1f}s" if lags else "n/a"
+        self.stdout.write(
+            f"{name}: {len(cells)} cells, coverage {100 * fresh / len(cells):.1f}% fresh at start "
+            f"({cold} cold), refreshed {refreshed} in {elapsed:.2f}s, {failed} failed, refresh lag {lag}"
+        )
+        return next_due
+
+    def handle(self, *args, **options):
+        try:
+            while True:
+                waits = [
+                    self.warm(name, grid, key_for, get_many, options["lead"], options["limit"])
+                    for name, grid, key_for, get_many in KINDS
+                ]
+                if not options["loop"]:
+                    return
+                waits = [w for w in waits if w is not None]
+                wait = min([options["max_sleep"], *waits])
+                time.sleep(max(1.0, wait))
+        except KeyboardInterrupt:
+            self.stdout.write("Prewarm loop stopped.")
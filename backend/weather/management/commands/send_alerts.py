@@ -1,18 +1,41 @@
+import argparse
 import hashlib
+import heapq
 import json
+import time
+from collections import defaultdict
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.management.base import BaseCommand
+from django.db.models.functions import Mod
 from django.utils import timezone
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 
-from weather.alerts import build_alerts
+from weather import leases
+from weather.alerts import PLAN
+from weather.cache_keys import FORECAST, SUBSCRIPTIONS_VERSION_KEY, send_lease_key, shard_lease_key, snap
+from weather.forecasts import FORECAST_TTL, get_forecasts
 from weather.models import AlertSubscription
-from weather.services import fetch_forecast
 
 
 SEVERITY_ORDER = {"info": 1, "warning": 2}
+SUBSCRIPTION_FIELDS = (
+    "id",
+    "name",
+    "lat",
+    "lon",
+    "timezone",
+    "min_severity",
+    "types",
+    "thresholds",
+    "last_sent_at",
+    "last_alert_hash",
+    "user__email",
+)
 
 
 def filter_alerts(alerts, types, min_severity):
@@ -32,62 +55,415 @@ def hash_alerts(alerts):
     return hashlib.sha256(payload).hexdigest()
 
 
+def build_message(sub, alerts):
+    lines = [
+        f"{alert.get('title')} - {alert.get('detail')}"
+        for alert in alerts
+    ]
+    return Mail(
+        from_email=settings.ALERTS_FROM_EMAIL,
+        to_emails=sub.user.email,
+        subject=f"WeatherPulse alerts for {sub.name}",
+        plain_text_content="\n".join(lines),
+    )
+
+
+def _timed(fn, *args):
+    started = time.perf_counter()
+    try:
+        return fn(*args), None, time.perf_counter() - started
+    except Exception as exc:
+        return None, exc, time.perf_counter() - started
+
+
+def is_duplicate(last_alert_hash, last_sent_at, payload_hash, now):
+    if last_alert_hash != payload_hash or not last_sent_at:
+        return False
+    delta = (now - last_sent_at).total_seconds() / 60
+    return delta < settings.ALERTS_MIN_INTERVAL_MINUTES
+
+
+def parse_shard(value):
+    """"i/N" for a fixed shard or "auto/N" to claim any free ones -> (i or None, N)."""
+    index, _, total = value.partition("/")
+    try:
+        total = int(total)
+        index = None if index == "auto" else int(index)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected i/N or auto/N")
+    if total < 1 or (index is not None and not 0 <= index < total):
+        raise argparse.ArgumentTypeError("shard index must be in 0..N-1")
+    return index, total
+
+
+def subscription_queryset(shards=None, total=None):
+    """
+    Subscriptions that have an email, with only the columns the command uses,
+    optionally restricted to the shards (id mod total) this worker owns.
+    """
+    qs = (
+        AlertSubscription.objects.select_related("user")
+        .exclude(user__email="")
+        .only(*SUBSCRIPTION_FIELDS)
+    )
+    if shards is not None:
+        qs = qs.annotate(shard=Mod("id", total)).filter(shard__in=shards)
+    return qs
+
+
+def iter_subscription_chunks(chunk_size, shards=None, total=None):
+    """Keyset-paginate subscriptions so memory stays flat as the table grows."""
+    qs = subscription_queryset(shards, total).order_by("id")
+    last_id = 0
+    while True:
+        chunk = list(qs.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1].id
+
+
+class DueQueue:
+    """
+    Min-heap of (due_at, subscription id). Rescheduling pushes a new entry and
+    the stale one is skipped when popped, so updates are O(log n).
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._due = {}
+
+    def __len__(self):
+        return len(self._due)
+
+    def schedule(self, sub_id, due_at):
+        self._due[sub_id] = due_at
+        heapq.heappush(self._heap, (due_at, sub_id))
+
+    def next_due(self):
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now, limit):
+        ids = []
+        while len(ids) < limit and self.next_due() is not None and self._heap[0][0] <= now:
+            _, sub_id = heapq.heappop(self._heap)
+            del self._due[sub_id]
+            ids.append(sub_id)
+        return ids
+
+
+def next_evaluation(last_sent_at, now):
+    """
+    A forecast cannot change before it expires, so a subscription is due again
+    one FORECAST_TTL after it was evaluated, and no earlier than
+    ALERTS_MIN_INTERVAL_MINUTES after its last email.
+    """
+    due = now + timedelta(seconds=FORECAST_TTL)
+    if last_sent_at:
+        due = max(due, last_sent_at + timedelta(minutes=settings.ALERTS_MIN_INTERVAL_MINUTES))
+    return due
+
+
 class Command(BaseCommand):
     help = "Send alert subscription emails."
 
+    def add_arguments(self, parser):
+        parser.add_argument("--fetch-workers", type=int, default=4, help="Concurrent forecast fetches.")
+        parser.add_argument("--send-workers", type=int, default=8, help="Concurrent SendGrid sends.")
+        parser.add_argument("--chunk-size", type=int, default=1000, help="Subscriptions loaded per query.")
+        parser.add_argument("--daemon", action="store_true", help="Keep running and evaluate subscriptions as they come due.")
+        parser.add_argument("--poll-seconds", type=float, default=5.0, help="Daemon: how often to check for subscription changes.")
+        parser.add_argument(
+            "--shard",
+            type=parse_shard,
+            help="Only handle subscriptions with id mod N == i (i/N), or claim any free shards (auto/N).",
+        )
+
     def handle(self, *args, **options):
         if not settings.SENDGRID_API_KEY or not settings.ALERTS_FROM_EMAIL:
             self.stdout.write("Missing SENDGRID_API_KEY or ALERTS_FROM_EMAIL. Skipping.")
             return
 
-        sg = SendGridAPIClient(settings.SENDGRID_API_KEY)
-        now = timezone.now()
-        min_interval = settings.ALERTS_MIN_INTERVAL_MINUTES
+        self.sg = SendGridAPIClient(settings.SENDGRID_API_KEY)
+        self.now = timezone.now()
+        self.busy = {"fetch": 0.0, "evaluate": 0.0, "send": 0.0}
+        self.owner = leases.new_owner()
+        self.shard_index, self.shard_total = options["shard"] or (None, None)
+        self.shards = None if options["shard"] is None else set()
+        started = time.perf_counter()
+        total = queued = sent = 0
 
-        subs = AlertSubscription.objects.select_related("user").all()
-        if not subs.exists():
+        try:
+            with ThreadPoolExecutor(max_workers=options["fetch_workers"]) as fetch_pool, \
+                    ThreadPoolExecutor(max_workers=options["send_workers"]) as send_pool:
+                if options["daemon"]:
+                    self.run_daemon(options, fetch_pool, send_pool)
+                    return
+                if self.shards is not None and not self.claim_shards():
+                    self.stdout.write("Shard lease is held by another worker. Skipping.")
+                    return
+                for chunk in iter_subscription_chunks(options["chunk_size"], self.shards, self.shard_total):
+                    if not self.renew_shards():
+                        self.stdout.write("Lost shard lease, stopping.")
+                        break
+                    total += len(chunk)
+                    chunk_queued, chunk_sent = self.process_chunk(chunk, fetch_pool, send_pool)
+                    queued += chunk_queued
+                    sent += chunk_sent
+        finally:
+            self.release_shards()
+
+        if not total:
             self.stdout.write("No alert subscriptions found.")
             return
 
-        for sub in subs:
-            if not sub.user.email:
-                continue
+        self.stdout.write(
+            f"Sent {sent}/{queued} alerts for {total} subscriptions in {time.perf_counter() - started:.2f}s "
+            f"(busy time: fetch {self.busy['fetch']:.2f}s, evaluate {self.busy['evaluate']:.2f}s, send {self.busy['send']:.2f}s)"
+        )
 
-            try:
-                forecast = fetch_forecast(sub.lat, sub.lon, sub.timezone)
-            except Exception as exc:
-                self.stdout.write(f"Fetch failed for {sub.name}: {exc}")
+    def claim_shards(self):
+        """
+        Take the lease of every wanted shard nobody holds. A crashed worker's
+        leases expire after ALERTS_SHARD_LEASE_SECONDS and are claimed here.
+        """
+        if self.shard_index is not None:
+            wanted = [self.shard_index]
+        else:
+            wanted = range(self.shard_total)
+        claimed = []
+        for shard in wanted:
+            if shard in self.shards:
                 continue
+            if leases.acquire(shard_lease_key(shard, self.shard_total), self.owner, settings.ALERTS_SHARD_LEASE_SECONDS):
+                self.shards.add(shard)
+                claimed.append(shard)
+        if claimed:
+            self.stdout.write(f"Claimed shard(s) {', '.join(map(str, claimed))} of {self.shard_total}.")
+        return claimed
 
-            alerts = build_alerts(forecast)
-            alerts = filter_alerts(alerts, sub.types or [], sub.min_severity)
-            if not alerts:
-                continue
+    def renew_shards(self):
+        """Extend held shard leases; drop (and report) any that were lost."""
+        if self.shards is None:
+            return True
+        kept = True
+        for shard in list(self.shards):
+            if not leases.renew(shard_lease_key(shard, self.shard_total), self.owner, settings.ALERTS_SHARD_LEASE_SECONDS):
+                self.shards.discard(shard)
+                self.stdout.write(f"Lost lease on shard {shard} of {self.shard_total}.")
+                kept = False
+        return kept
+
+    def release_shards(self):
+        for shard in self.shards or ():
+            leases.release(shard_lease_key(shard, self.shard_total), self.owner)
+
+    def process_chunk(self, subs, fetch_pool, send_pool):
+        # Subscriptions in the same forecast cell and timezone share one
+        # forecast and, unless they override thresholds, one build_alerts result.
+        groups = defaultdict(list)
+        for sub in subs:
+            lat, lon = snap(sub.lat, sub.lon, FORECAST)
+            groups[(lat, lon, sub.timezone)].append(sub)
 
-            payload_hash = hash_alerts(alerts)
-            if sub.last_alert_hash == payload_hash and sub.last_sent_at:
-                delta = (now - sub.last_sent_at).total_seconds() / 60
-                if delta < min_interval:
+        cells = list(groups)
+        self.stdout.write(f"Evaluating {len(subs)} subscriptions across {len(cells)} locations.")
+
+        # Fetch -> evaluate -> send, with each stage on its own bounded pool.
+        # Sends are queued as soon as a forecast chunk arrives; state changes
+        # are written back once per subscription chunk with bulk_update.
+        size = settings.FORECAST_BATCH_SIZE
+        fetches = {
+            fetch_pool.submit(_timed, get_forecasts, cells[i:i + size]): cells[i:i + size]
+            for i in range(0, len(cells), size)
+        }
+        sends = {}
+        leased = []
+        try:
+            for future in as_completed(fetches):
+                chunk = fetches[future]
+                results, error, elapsed = future.result()
+                self.busy["fetch"] += elapsed
+                if error is not None:
+                    self.stdout.write(f"Fetch failed for {len(chunk)} locations: {error}")
                     continue
 
-            subject = f"WeatherPulse alerts for {sub.name}"
-            lines = [
-                f"{alert.get('title')} - {alert.get('detail')}"
-                for alert in alerts
-            ]
-            content = "\n".join(lines)
-
-            message = Mail(
-                from_email=settings.ALERTS_FROM_EMAIL,
-                to_emails=sub.user.email,
-                subject=subject,
-                plain_text_content=content,
-            )
-            try:
-                sg.send(message)
+                evaluate_started = time.perf_counter()
+                candidates = []
+                for cell, (entry, info) in zip(chunk, results):
+                    if entry is None or info["stale"]:
+                        names = ", ".join(sub.name for sub in groups[cell])
+                        self.stdout.write(f"Fetch failed for {names}")
+                        continue
+
+                    # Subscriptions with threshold overrides re-evaluate the
+                    # rules against one compiled view of the cell's forecast.
+                    view = None
+                    for sub in groups[cell]:
+                        cell_alerts = entry["alerts"]
+                        if sub.thresholds:
+                            if view is None:
+                                view = PLAN.view(entry["forecast"])
+                            cell_alerts = PLAN.evaluate(view, sub.thresholds)
+                        alerts = filter_alerts(cell_alerts, sub.types or [], sub.min_severity)
+                        if not alerts:
+                            continue
+                        payload_hash = hash_alerts(alerts)
+                        if is_duplicate(sub.last_alert_hash, sub.last_sent_at, payload_hash, self.now):
+                            continue
+                        candidates.append((sub, alerts, payload_hash))
+
+                for sub, alerts, payload_hash in self.lease_sends(candidates, leased):
+                    message = build_message(sub, alerts)
+                    sends[send_pool.submit(_timed, self.sg.send, message)] = (sub, payload_hash)
+                self.busy["evaluate"] += time.perf_counter() - evaluate_started
+
+            updated = []
+            for future in as_completed(sends):
+                sub, payload_hash = sends[future]
+                _, error, elapsed = future.result()
+                self.busy["send"] += elapsed
+                if error is not None:
+                    self.stdout.write(f"Send failed for {sub.user.email}: {error}")
+                    continue
                 sub.last_alert_hash = payload_hash
-                sub.last_sent_at = now
-                sub.save(update_fields=["last_alert_hash", "last_sent_at"])
+                sub.last_sent_at = self.now
+                updated.append(sub)
                 self.stdout.write(f"Sent alerts to {sub.user.email} ({sub.name})")
-            except Exception as exc:
-                self.stdout.write(f"Send failed for {sub.user.email}: {exc}")
+
+            if updated:
+                AlertSubscription.objects.bulk_update(updated, ["last_alert_hash", "last_sent_at"])
+        finally:
+            for sub_id in leased:
+                leases.release(send_lease_key(sub_id), self.owner)
+        return len(sends), len(updated)
+
+    def lease_sends(self, candidates, leased):
+        """
+        Take a short per-subscription lease before sending, then re-check the
+        dedup state from the database: another worker may have sent (and
+        released its lease) after our copy of the row was loaded. Leases are
+        held until our own bulk_update has landed.
+        """
+        held = []
+        for candidate in candidates:
+            sub_id = candidate[0].id
+            if leases.acquire(send_lease_key(sub_id), self.owner, settings.ALERTS_SEND_LEASE_SECONDS):
+                leased.append(sub_id)
+                held.append(candidate)
+        if not held:
+            return []
+        rows = AlertSubscription.objects.filter(id__in=[sub.id for sub, _, _ in held])
+        current = {
+            sub_id: (last_alert_hash, last_sent_at)
+            for sub_id, last_alert_hash, last_sent_at in rows.values_list("id", "last_alert_hash", "last_sent_at")
+        }
+        return [
+            (sub, alerts, payload_hash)
+            for sub, alerts, payload_hash in held
+            if sub.id in current and not is_duplicate(*current[sub.id], payload_hash, self.now)
+        ]
+
+    def load_schedule(self, queue, shards=None):
+        """Schedule every subscription (in `shards`, if sharded); returns the newest updated_at."""
+        watermark = None
+        now = timezone.now()
+        qs = subscription_queryset(shards, self.shard_total)
+        for sub_id, last_sent_at, updated_at in qs.values_list("id", "last_sent_at", "updated_at").iterator():
+            due = now
+            if last_sent_at:
+                due = max(now, last_sent_at + timedelta(minutes=settings.ALERTS_MIN_INTERVAL_MINUTES))
+            queue.schedule(sub_id, due)
+            self.seen[sub_id] = updated_at
+            watermark = updated_at if watermark is None or updated_at > watermark else watermark
+        self.forget_seen(watermark)
+        return watermark
+
+    def schedule_changes(self, queue, watermark):
+        """
+        Schedule subscriptions created or edited since `watermark`; returns the
+        new watermark. Rows are re-queried ALERTS_CHANGE_SKEW_SECONDS back,
+        because web hosts' clocks drift and a transaction that commits late can
+        carry an updated_at older than rows already seen. `self.seen` keeps the
+        updated_at of rows inside that margin so each edit is scheduled once.
+        """
+        changed = subscription_queryset(self.shards, self.shard_total).values_list("id", "updated_at")
+        if watermark is not None:
+            changed = changed.filter(
+                updated_at__gte=watermark - timedelta(seconds=settings.ALERTS_CHANGE_SKEW_SECONDS)
+            )
+        now = timezone.now()
+        for sub_id, updated_at in changed:
+            if self.seen.get(sub_id) != updated_at:
+                self.seen[sub_id] = updated_at
+                queue.schedule(sub_id, now)
+            watermark = updated_at if watermark is None or updated_at > watermark else watermark
+        self.forget_seen(watermark)
+        return watermark
+
+    def forget_seen(self, watermark):
+        """Drop rows that fell out of the skew margin; the next query cannot return them."""
+        if watermark is None:
+            return
+        horizon = watermark - timedelta(seconds=settings.ALERTS_CHANGE_SKEW_SECONDS)
+        self.seen = {sub_id: updated_at for sub_id, updated_at in self.seen.items() if updated_at >= horizon}
+
+    def run_daemon(self, options, fetch_pool, send_pool):
+        """
+        Keep every subscription in a DueQueue and only load the ones that are
+        due. New or edited rows are picked up through the change marker bumped
+        by weather.signals plus an indexed updated_at query (schedule_changes);
+        deleted rows simply fail to load when they come due and are dropped.
+
+        When sharded, the daemon renews its shard leases a few times per lease
+        period and keeps trying to claim free shards, so a standby (or an
+        auto/N peer) takes over a crashed worker's shard once its lease expires.
+        """
+        queue = DueQueue()
+        self.seen = {}
+        version = cache.get(SUBSCRIPTIONS_VERSION_KEY)
+        watermark = None
+        lease_check = 0.0
+        if self.shards is None:
+            watermark = self.load_schedule(queue)
+        self.stdout.write(f"Daemon started with {len(queue)} subscriptions.")
+
+        try:
+            while True:
+                if self.shards is not None and time.monotonic() >= lease_check:
+                    lease_check = time.monotonic() + settings.ALERTS_SHARD_LEASE_SECONDS / 3
+                    self.renew_shards()
+                    claimed = self.claim_shards()
+                    if claimed:
+                        latest = self.load_schedule(queue, claimed)
+                        if latest is not None and (watermark is None or latest > watermark):
+                            watermark = latest
+
+                current = cache.get(SUBSCRIPTIONS_VERSION_KEY)
+                if current != version:
+                    version = current
+                    watermark = self.schedule_changes(queue, watermark)
+
+                self.now = timezone.now()
+                ids = queue.pop_due(self.now, options["chunk_size"])
+                if self.shards is not None:
+                    # Rows of shards lost to another worker are dropped here.
+                    ids = [sub_id for sub_id in ids if sub_id % self.shard_total in self.shards]
+                if ids:
+                    subs = list(subscription_queryset().filter(id__in=ids))
+                    self.process_chunk(subs, fetch_pool, send_pool)
+                    for sub in subs:
+                        queue.schedule(sub.id, next_evaluation(sub.last_sent_at, self.now))
+                    continue
+
+                next_due = queue.next_due()
+                wait = options["poll_seconds"]
+                if next_due is not None:
+                    wait = min(wait, max(0.0, (next_due - timezone.now()).total_seconds()))
+                if self.shards is not None:
+                    wait = min(wait, max(0.0, lease_check - time.monotonic()))
+                time.sleep(wait)
+        except KeyboardInterrupt:
+            self.stdout.write("Daemon stopped.")
@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("weather", "0005_userpreference_timeformat"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="GeocodeResult",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("kind", models.CharField(choices=[("city", "City"), ("address", "Address"), ("reverse", "Reverse")], max_length=10)),
+                ("query", models.CharField(max_length=255)),
+                ("result", models.JSONField(blank=True, null=True)),
+                ("fetched_at", models.DateTimeField()),
+            ],
+            options={
+                "unique_together": {("kind", "query")},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("weather", "0006_geocoderesult"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="alertsubscription",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
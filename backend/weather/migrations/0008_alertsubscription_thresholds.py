@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("weather", "0007_alertsubscription_updated_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="alertsubscription",
+            name="thresholds",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -42,12 +42,33 @@ class AlertSubscription(models.Model):
     timezone = models.CharField(max_length=64, default="auto")
     min_severity = models.CharField(max_length=10, choices=SEVERITY_CHOICES, default="info")
     types = models.JSONField(default=default_alert_types)
+    # Per-rule threshold overrides, e.g. {"wind": {"warning": 50}}. See weather.alerts.RULES.
+    thresholds = models.JSONField(default=dict, blank=True)
     last_sent_at = models.DateTimeField(null=True, blank=True)
     last_alert_hash = models.CharField(max_length=64, blank=True, default="")
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     class Meta:
         unique_together = ("user", "lat", "lon")
 
     def __str__(self):
         return f"{self.name} ({self.user})"
+
+class GeocodeResult(models.Model):
+    KIND_CHOICES = [
+        ("city", "City"),
+        ("address", "Address"),
+        ("reverse", "Reverse"),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    query = models.CharField(max_length=255)
+    result = models.JSONField(null=True, blank=True)
+    fetched_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ("kind", "query")
+
+    def __str__(self):
+        return f"{self.kind}:{self.query}"
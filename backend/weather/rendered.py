@@ -0,0 +1,57 @@
+import gzip
+import json
+
+try:
+    import brotli
+except ImportError:  # optional: without it responses fall back to gzip
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# Bodies smaller than this are sent as is; compression would not pay for the header.
+MIN_COMPRESS_BYTES = 256
+# Rendered bodies are keyed by ETag, so they can outlive a short max-age safely.
+MIN_SECONDS = 60
+
+
+def render(body) -> dict:
+    """
+    The JSON bytes of `body` (as _json would send them) plus gzip and, when
+    the brotli package is installed, brotli copies, keyed by content coding.
+    """
+    raw = json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    bodies = {"identity": raw}
+    if len(raw) >= MIN_COMPRESS_BYTES:
+        bodies["gzip"] = gzip.compress(raw, GZIP_LEVEL, mtime=0)
+        if brotli is not None:
+            bodies["br"] = brotli.compress(raw, quality=BROTLI_QUALITY)
+    return bodies
+
+
+def accepted_encodings(header: str) -> dict:
+    """Accept-Encoding as {coding: q}, e.g. "br;q=1, gzip;q=0.5" -> {"br": 1.0, "gzip": 0.5}."""
+    accepted = {}
+    for part in (header or "").split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    return accepted
+
+
+def negotiate(header: str, bodies: dict) -> str:
+    """Best available coding the client accepts: br, then gzip, then identity."""
+    accepted = accepted_encodings(header)
+    for coding in ("br", "gzip"):
+        if coding in bodies and accepted.get(coding, accepted.get("*", 0)) > 0:
+            return coding
+    return "identity"
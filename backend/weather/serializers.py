@@ -1,5 +1,6 @@
 from django.contrib.auth.models import User
 from rest_framework import serializers
+from .alerts import PLAN
 from .models import SavedLocation, AlertSubscription
 
 class RegisterSerializer(serializers.ModelSerializer):
@@ -37,7 +38,7 @@ class SavedLocationSerializer(serializers.ModelSerializer):
 class AlertSubscriptionSerializer(serializers.ModelSerializer):
     class Meta:
         model = AlertSubscription
-        fields = ["id", "name", "country", "admin1", "lat", "lon", "timezone", "min_severity", "types", "created_at"]
+        fields = ["id", "name", "country", "admin1", "lat", "lon", "timezone", "min_severity", "types", "thresholds", "created_at"]
         read_only_fields = ["id", "created_at"]
 
     def validate_types(self, value):
@@ -50,3 +51,39 @@ class AlertSubscriptionSerializer(serializers.ModelSerializer):
         if not value:
             raise serializers.ValidationError("Select at least one type")
         return value
+
+    def validate_thresholds(self, value):
+        if not isinstance(value, dict):
+            raise serializers.ValidationError("thresholds must be an object")
+        invalid = [rule for rule in value if rule not in PLAN.rule_ids]
+        if invalid:
+            raise serializers.ValidationError(f"Unknown rules: {', '.join(invalid)}")
+        for rule, levels in value.items():
+            if not isinstance(levels, dict) or not all(
+                severity in {"info", "warning"} and isinstance(threshold, (int, float)) and not isinstance(threshold, bool)
+                for severity, threshold in levels.items()
+            ):
+                raise serializers.ValidationError(f"{rule} must map info/warning to a number")
+        return value
+
+
+class BatchLocationSerializer(serializers.Serializer):
+    lat = serializers.FloatField(min_value=-90, max_value=90)
+    lon = serializers.FloatField(min_value=-180, max_value=180)
+    timezone = serializers.CharField(max_length=64, required=False, default="auto")
+    name = serializers.CharField(max_length=120, required=False, allow_blank=True, default="")
+
+
+class WeatherBatchSerializer(serializers.Serializer):
+    MAX_LOCATIONS = 50
+
+    locations = BatchLocationSerializer(many=True, required=False, default=list)
+    saved_location_ids = serializers.ListField(child=serializers.IntegerField(), required=False, default=list)
+
+    def validate(self, attrs):
+        total = len(attrs["locations"]) + len(attrs["saved_location_ids"])
+        if not total:
+            raise serializers.ValidationError("Provide locations or saved_location_ids")
+        if total > self.MAX_LOCATIONS:
+            raise serializers.ValidationError(f"At most {self.MAX_LOCATIONS} locations per request")
+        return attrs
@@ -1,4 +1,4 @@
-import requests
+from . import upstream
 
 GEOCODE_URL = "https://geocoding-api.open-meteo.com/v1/search"
 REVERSE_GEOCODE_URL = "https://geocoding-api.open-meteo.com/v1/reverse"
@@ -6,19 +6,10 @@ NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
 FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
 AIR_QUALITY_URL = "https://air-quality-api.open-meteo.com/v1/air-quality"
 
-def geocode_city(city: str):
-    r = requests.get(
-        GEOCODE_URL,
-        params={"name": city, "count": 5, "language": "en", "format": "json"},
-        timeout=10,
-    )
-    r.raise_for_status()
-    data = r.json()
-    results = data.get("results") or []
-    if not results:
-        return None
+def _geocode_city_params(city: str):
+    return {"name": city, "count": 5, "language": "en", "format": "json"}
 
-    top = results[0]
+def _parse_place(top):
     return {
         "name": top.get("name"),
         "country": top.get("country"),
@@ -28,89 +19,192 @@ def geocode_city(city: str):
         "timezone": top.get("timezone") or "auto",
     }
 
-def geocode_address(query: str):
+def _parse_geocode_city(data):
+    results = data.get("results") or []
+    if not results:
+        return None
+
+    return _parse_place(results[0])
+
+def _parse_places(data):
+    return [
+        {**_parse_place(r), "population": r.get("population") or 0}
+        for r in data.get("results") or []
+    ]
+
+def _geocode_address_params(query: str):
+    return {"q": query, "format": "json", "limit": 1, "addressdetails": 1}
+
+def _parse_geocode_address(results):
+    if not results:
+        return None
+    top = results[0]
+    address = top.get("address") or {}
+    name = address.get("attraction") or address.get("amenity") or address.get("road") or address.get("suburb")
+    city = address.get("city") or address.get("town") or address.get("village")
+    region = address.get("state") or address.get("province") or ""
+    country = address.get("country") or ""
+    return {
+        "name": name or city or top.get("display_name", "").split(",")[0] or "Current location",
+        "country": country,
+        "admin1": region,
+        "lat": float(top.get("lat")),
+        "lon": float(top.get("lon")),
+        "timezone": "auto",
+    }
+
+def _reverse_geocode_params(lat: float, lon: float):
+    return {"latitude": lat, "longitude": lon, "language": "en", "format": "json"}
+
+def _parse_reverse_geocode(data, lat: float, lon: float):
+    results = data.get("results") or []
+    if not results:
+        return None
+
+    top = results[0]
+    name = (
+        top.get("name")
+        or top.get("city")
+        or top.get("town")
+        or top.get("village")
+        or top.get("admin2")
+        or top.get("admin1")
+        or "Current location"
+    )
+    return {
+        "name": name,
+        "country": top.get("country") or "",
+        "admin1": top.get("admin1") or "",
+        "lat": top.get("latitude") or lat,
+        "lon": top.get("longitude") or lon,
+        "timezone": top.get("timezone") or "auto",
+    }
+
+FORECAST_VARIABLES = {
+    "current": "temperature_2m,relative_humidity_2m,apparent_temperature,precipitation,weather_code,wind_speed_10m,wind_direction_10m,uv_index",
+    "hourly": "temperature_2m,apparent_temperature,precipitation_probability,precipitation,weather_code,wind_speed_10m,uv_index",
+    "daily": "weather_code,temperature_2m_max,temperature_2m_min,precipitation_probability_max,uv_index_max,sunrise,sunset",
+}
+
+def _forecast_params(lat: float, lon: float, timezone: str, blocks=None, days=None):
+    params = {"latitude": lat, "longitude": lon, "timezone": timezone}
+    for block in blocks or FORECAST_VARIABLES:
+        params[block] = FORECAST_VARIABLES[block]
+    if days:
+        params["forecast_days"] = days
+    return params
+
+def _aqi_params(lat: float, lon: float, timezone: str):
+    return {
+        "latitude": lat,
+        "longitude": lon,
+        "timezone": timezone,
+        "current": "us_aqi,pm2_5,pm10,carbon_monoxide,nitrogen_dioxide,sulphur_dioxide,ozone",
+    }
+
+def geocode_city(city: str):
+    r = upstream.get(upstream.OPEN_METEO, GEOCODE_URL, params=_geocode_city_params(city))
+    r.raise_for_status()
+    return _parse_geocode_city(r.json())
+
+def search_places(query: str, count: int = 5):
+    params = {**_geocode_city_params(query), "count": count}
+    r = upstream.get(upstream.OPEN_METEO, GEOCODE_URL, params=params)
+    r.raise_for_status()
+    return _parse_places(r.json())
+
+def geocode_address(query: str, raise_errors: bool = False):
     try:
-        r = requests.get(
-            NOMINATIM_URL,
-            params={"q": query, "format": "json", "limit": 1, "addressdetails": 1},
-            headers={"User-Agent": "WeatherPulse/1.0"},
-            timeout=10,
-        )
+        r = upstream.get(upstream.NOMINATIM, NOMINATIM_URL, params=_geocode_address_params(query))
         r.raise_for_status()
-        results = r.json() or []
-        if not results:
-            return None
-        top = results[0]
-        address = top.get("address") or {}
-        name = address.get("attraction") or address.get("amenity") or address.get("road") or address.get("suburb")
-        city = address.get("city") or address.get("town") or address.get("village")
-        region = address.get("state") or address.get("province") or ""
-        country = address.get("country") or ""
-        return {
-            "name": name or city or top.get("display_name", "").split(",")[0] or "Current location",
-            "country": country,
-            "admin1": region,
-            "lat": float(top.get("lat")),
-            "lon": float(top.get("lon")),
-            "timezone": "auto",
-        }
+        return _parse_geocode_address(r.json() or [])
     except Exception:
+        if raise_errors:
+            raise
         return None
 
-def reverse_geocode(lat: float, lon: float):
+def reverse_geocode(lat: float, lon: float, raise_errors: bool = False):
     try:
-        r = requests.get(
-            REVERSE_GEOCODE_URL,
-            params={"latitude": lat, "longitude": lon, "language": "en", "format": "json"},
-            timeout=10,
-        )
+        r = upstream.get(upstream.OPEN_METEO, REVERSE_GEOCODE_URL, params=_reverse_geocode_params(lat, lon))
         r.raise_for_status()
-        data = r.json()
-        results = data.get("results") or []
-        if not results:
-            return None
-
-        top = results[0]
-        name = (
-            top.get("name")
-            or top.get("city")
-            or top.get("town")
-            or top.get("village")
-            or top.get("admin2")
-            or top.get("admin1")
-            or "Current location"
-        )
-        return {
-            "name": name,
-            "country": top.get("country") or "",
-            "admin1": top.get("admin1") or "",
-            "lat": top.get("latitude") or lat,
-            "lon": top.get("longitude") or lon,
-            "timezone": top.get("timezone") or "auto",
-        }
+        return _parse_reverse_geocode(r.json(), lat, lon)
     except Exception:
+        if raise_errors:
+            raise
         return None
 
 def fetch_forecast(lat: float, lon: float, timezone: str = "auto"):
-    params = {
-        "latitude": lat,
-        "longitude": lon,
-        "timezone": timezone,
-        "current": "temperature_2m,relative_humidity_2m,apparent_temperature,precipitation,weather_code,wind_speed_10m,wind_direction_10m,uv_index",
-        "hourly": "temperature_2m,apparent_temperature,precipitation_probability,precipitation,weather_code,wind_speed_10m,uv_index",
-        "daily": "weather_code,temperature_2m_max,temperature_2m_min,precipitation_probability_max,uv_index_max,sunrise,sunset",
-    }
-    r = requests.get(FORECAST_URL, params=params, timeout=10)
+    r = upstream.get(upstream.OPEN_METEO, FORECAST_URL, params=_forecast_params(lat, lon, timezone))
     r.raise_for_status()
     return r.json()
 
+def fetch_forecasts(coords, timezone: str = "auto"):
+    """
+    One request for many points: Open-Meteo takes comma-separated latitude and
+    longitude lists and answers with a list in the same order.
+    """
+    params = _forecast_params(
+        ",".join(str(lat) for lat, _ in coords),
+        ",".join(str(lon) for _, lon in coords),
+        timezone,
+    )
+    r = upstream.get(upstream.OPEN_METEO, FORECAST_URL, params=params)
+    r.raise_for_status()
+    data = r.json()
+    return data if isinstance(data, list) else [data]
+
 def fetch_aqi(lat: float, lon: float, timezone: str = "auto"):
-    params = {
-        "latitude": lat,
-        "longitude": lon,
-        "timezone": timezone,
-        "current": "us_aqi,pm2_5,pm10,carbon_monoxide,nitrogen_dioxide,sulphur_dioxide,ozone",
-    }
-    r = requests.get(AIR_QUALITY_URL, params=params, timeout=10)
+    r = upstream.get(upstream.OPEN_METEO, AIR_QUALITY_URL, params=_aqi_params(lat, lon, timezone))
+    r.raise_for_status()
+    return r.json()
+
+def fetch_aqis(coords, timezone: str = "auto"):
+    """Multi-point counterpart of fetch_aqi, like fetch_forecasts."""
+    params = _aqi_params(
+        ",".join(str(lat) for lat, _ in coords),
+        ",".join(str(lon) for _, lon in coords),
+        timezone,
+    )
+    r = upstream.get(upstream.OPEN_METEO, AIR_QUALITY_URL, params=params)
+    r.raise_for_status()
+    data = r.json()
+    return data if isinstance(data, list) else [data]
+
+# Async variants for the ASGI views. Same requests and parsing as above, but
+# awaiting the network on the event loop instead of blocking a thread.
+
+async def ageocode_city(city: str):
+    r = await upstream.aget(upstream.OPEN_METEO, GEOCODE_URL, params=_geocode_city_params(city))
+    r.raise_for_status()
+    return _parse_geocode_city(r.json())
+
+async def ageocode_address(query: str, raise_errors: bool = False):
+    try:
+        r = await upstream.aget(upstream.NOMINATIM, NOMINATIM_URL, params=_geocode_address_params(query))
+        r.raise_for_status()
+        return _parse_geocode_address(r.json() or [])
+    except Exception:
+        if raise_errors:
+            raise
+        return None
+
+async def areverse_geocode(lat: float, lon: float, raise_errors: bool = False):
+    try:
+        r = await upstream.aget(upstream.OPEN_METEO, REVERSE_GEOCODE_URL, params=_reverse_geocode_params(lat, lon))
+        r.raise_for_status()
+        return _parse_reverse_geocode(r.json(), lat, lon)
+    except Exception:
+        if raise_errors:
+            raise
+        return None
+
+async def afetch_forecast(lat: float, lon: float, timezone: str = "auto", blocks=None, days=None):
+    params = _forecast_params(lat, lon, timezone, blocks, days)
+    r = await upstream.aget(upstream.OPEN_METEO, FORECAST_URL, params=params)
+    r.raise_for_status()
+    return r.json()
+
+async def afetch_aqi(lat: float, lon: float, timezone: str = "auto"):
+    r = await upstream.aget(upstream.OPEN_METEO, AIR_QUALITY_URL, params=_aqi_params(lat, lon, timezone))
     r.raise_for_status()
     return r.json()
@@ -0,0 +1,31 @@
+import logging
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cache_keys import SUBSCRIPTIONS_VERSION_KEY
+from .models import AlertSubscription
+
+logger = logging.getLogger(__name__)
+
+
+def _bump_version():
+    try:
+        try:
+            cache.incr(SUBSCRIPTIONS_VERSION_KEY)
+        except ValueError:
+            cache.set(SUBSCRIPTIONS_VERSION_KEY, 1, timeout=None)
+    except Exception as exc:  # the cache backend's own errors, e.g. Redis being down
+        logger.warning("Could not bump the alert subscriptions change marker: %s", exc)
+
+
+@receiver([post_save, post_delete], sender=AlertSubscription)
+def bump_subscriptions_version(sender, **kwargs):
+    """
+    Change marker polled by `send_alerts --daemon`. It is bumped once the
+    write commits, so the daemon's query can see the row, and never fails
+    the write: a bump lost to a cache outage is covered by the next one.
+    """
+    transaction.on_commit(_bump_version)
@@ -0,0 +1,191 @@
+import bisect
+import csv
+import threading
+import time
+import unicodedata
+from pathlib import Path
+
+from django.conf import settings
+
+from . import services
+from .cache_keys import forecast_key, geocode_key
+from .caching import is_envelope, payload, read, read_many, write
+from .models import GeocodeResult
+
+# Longest run of alphabetically adjacent matches ranked for one prefix. Only
+# very short prefixes against a large gazetteer ever hit it.
+SCAN_LIMIT = 2000
+
+# Batches up to this size are bisected into the index one by one; larger ones
+# (the gazetteer) are appended and sorted once, since every list.insert shifts
+# the whole tail.
+INSERT_LIMIT = 64
+
+
+def fold(text: str) -> str:
+    """Case- and accent-insensitive form used for index keys and queries."""
+    text = text.casefold()
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return " ".join(text.split())
+
+
+class PrefixIndex:
+    """
+    Place names kept as a sorted list of folded keys. A prefix lookup is two
+    bisects giving a contiguous slice, which is then ranked by population.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._places = []
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    @staticmethod
+    def _ident(place: dict):
+        name = place.get("name")
+        if not name or place.get("lat") is None or place.get("lon") is None:
+            return None
+        return fold(name), round(place["lat"], 2), round(place["lon"], 2)
+
+    def add(self, place: dict):
+        self.add_many([place])
+
+    def add_many(self, places):
+        candidates = [(ident, place) for place in places if (ident := self._ident(place)) is not None]
+        with self._lock:
+            fresh = []
+            for ident, place in candidates:
+                if ident not in self._seen:
+                    self._seen.add(ident)
+                    fresh.append((ident[0], place))
+            if len(fresh) <= INSERT_LIMIT:
+                for key, place in fresh:
+                    i = bisect.bisect_right(self._keys, key)
+                    self._keys.insert(i, key)
+                    self._places.insert(i, place)
+                return
+            keys = self._keys + [key for key, _ in fresh]
+            places = self._places + [place for _, place in fresh]
+            # Stable, so equal keys keep insertion order as bisect_right would.
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+            self._keys = [keys[i] for i in order]
+            self._places = [places[i] for i in order]
+
+    def search(self, prefix: str, limit: int = 5):
+        prefix = fold(prefix)
+        if not prefix:
+            return []
+        with self._lock:
+            lo = bisect.bisect_left(self._keys, prefix)
+            hi = bisect.bisect_left(self._keys, prefix + "\uffff", lo)
+            candidates = self._places[lo:min(hi, lo + SCAN_LIMIT)]
+        candidates.sort(key=lambda p: -(p.get("population") or 0))
+        return candidates[:limit]
+
+
+_index = PrefixIndex()
+_state = {"loaded_at": None, "synced_at": None}
+_load_lock = threading.Lock()
+
+
+def _gazetteer_places(path: Path):
+    with path.open(newline="", encoding="utf-8") as fh:
+        for row in csv.DictReader(fh):
+            try:
+                yield {
+                    "name": row["name"],
+                    "country": row.get("country") or "",
+                    "admin1": row.get("admin1") or "",
+                    "lat": float(row["lat"]),
+                    "lon": float(row["lon"]),
+                    "timezone": row.get("timezone") or "auto",
+                    "population": int(row.get("population") or 0),
+                }
+            except (KeyError, ValueError):
+                continue
+
+
+def _cached_geocodes(since=None):
+    qs = GeocodeResult.objects.filter(kind__in=["city", "address"], result__isnull=False)
+    if since is not None:
+        qs = qs.filter(fetched_at__gt=since)
+    return qs.values_list("result", "fetched_at")
+
+
+def _sync_from_db():
+    latest = _state["synced_at"]
+    results = []
+    for result, fetched_at in _cached_geocodes(since=latest).iterator():
+        results.append(result)
+        if latest is None or fetched_at > latest:
+            latest = fetched_at
+    _index.add_many(results)
+    _state["synced_at"] = latest
+
+
+def get_index() -> PrefixIndex:
+    """
+    The index is filled on first use from SUGGEST_GAZETTEER_PATH (a CSV with
+    name,country,admin1,lat,lon,timezone,population columns) and every cached
+    geocoding result, then topped up with newer geocodes every
+    SUGGEST_REFRESH_SECONDS.
+    """
+    now = time.monotonic()
+    loaded_at = _state["loaded_at"]
+    if loaded_at is not None and now - loaded_at < settings.SUGGEST_REFRESH_SECONDS:
+        return _index
+    with _load_lock:
+        if _state["loaded_at"] is None:
+            path = Path(settings.SUGGEST_GAZETTEER_PATH) if settings.SUGGEST_GAZETTEER_PATH else None
+            if path and path.exists():
+                _index.add_many(_gazetteer_places(path))
+        if _state["loaded_at"] is None or now - _state["loaded_at"] >= settings.SUGGEST_REFRESH_SECONDS:
+            _sync_from_db()
+            _state["loaded_at"] = now
+    return _index
+
+
+def search_upstream(query: str, limit: int):
+    """
+    Fallback for prefixes the index cannot answer. Results are cached like
+    other geocodes and added to the index, so the next keystroke stays local.
+    """
+    key = geocode_key("search", fold(query))
+    hit = read(key)
+    if hit is None:
+        places = services.search_places(query, count=limit)
+        write(key, {"result": places}, settings.GEOCODE_CACHE_TTL if places else settings.GEOCODE_MISS_TTL)
+    else:
+        places = hit["result"]
+    _index.add_many(places)
+    return places
+
+
+def attach_current(places):
+    """Current temperatures from the forecast cache, in one get_many."""
+    keys = [forecast_key(p["lat"], p["lon"], p.get("timezone") or "auto") for p in places]
+    entries = read_many(keys)
+    results = []
+    for place, key in zip(places, keys):
+        entry = entries.get(key)
+        current = {}
+        if is_envelope(entry):
+            current = (payload(entry, series=False).get("forecast") or {}).get("current") or {}
+        results.append({
+            "id": f"{place['lat']}:{place['lon']}",
+            "name": place.get("name"),
+            "country": place.get("country") or "",
+            "admin1": place.get("admin1") or "",
+            "lat": place["lat"],
+            "lon": place["lon"],
+            "timezone": place.get("timezone") or "auto",
+            "temp": current.get("temperature_2m"),
+            "feels": current.get("apparent_temperature"),
+        })
+    return results
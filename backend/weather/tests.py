@@ -1,3 +1,926 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import random
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from django.utils.http import http_date
+from rest_framework.test import APIClient
+
+from . import admission, caching, codec, leases, throttle
+from .alerts import build_alerts
+from .cache_keys import SUBSCRIPTIONS_VERSION_KEY, forecast_key, send_lease_key, shard_lease_key
+from .forecasts import FORECAST_TTL, forecast_entry
+from .management.commands.send_alerts import Command as SendAlertsCommand, DueQueue, hash_alerts, subscription_queryset
+from .models import AlertSubscription, SavedLocation
+from .serializers import AlertSubscriptionSerializer
+from .suggest import INSERT_LIMIT, PrefixIndex
+
+LOCMEM = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+def cache_forecast(lat, lon, forecast, age=0, timezone="UTC"):
+    """Store `forecast` as the canonical entry for the cell, fetched `age` seconds ago."""
+    entry = caching.envelope(forecast_entry(forecast), FORECAST_TTL, fetched_at=time.time() - age)
+    caching.write(forecast_key(lat, lon, timezone), caching.packed(entry), caching.storage_timeout(entry))
+    return entry
+
+
+def store(key, value, ttl=60, age=0):
+    """Cache `value` under `key` as an envelope fetched `age` seconds ago."""
+    entry = caching.envelope(value, ttl, fetched_at=time.time() - age)
+    caching.write(key, caching.packed(entry), caching.storage_timeout(entry))
+
+
+@override_settings(CACHES=LOCMEM)
+class DashboardTests(TestCase):
+    def setUp(self):
+        caching._local.clear()
+        self.user = User.objects.create_user("dash", "dash@example.com", "password123")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add_location(self, lat, lon):
+        loc = SavedLocation.objects.create(user=self.user, name=f"{lat},{lon}", lat=lat, lon=lon, timezone="UTC")
+        hourly = {"time": [f"2026-10-18T{h:02d}:00" for h in range(10)], "temperature_2m": list(range(10))}
+        cache_forecast(lat, lon, {"current": {"temperature_2m": lat, "wind_speed_10m": 50}, "hourly": hourly})
+        return loc
+
+    def test_fixed_query_count(self):
+        self.add_location(10, 20)
+        AlertSubscription.objects.create(user=self.user, name="a", lat=10, lon=20, timezone="UTC")
+        with self.assertNumQueries(3):
+            self.client.get("/api/dashboard")
+        for i in range(5):
+            self.add_location(30 + i, 40)
+        with self.assertNumQueries(3):
+            response = self.client.get("/api/dashboard")
+
+        data = response.json()
+        self.assertEqual(len(data["saved_locations"]), 6)
+        self.assertEqual(len(data["alert_subscriptions"]), 1)
+        self.assertEqual(data["preferences"]["unit"], "C")
+        self.assertEqual(data["weather"]["active"]["location"]["lat"], 34)
+        self.assertEqual(data["weather"]["active"]["alerts"][0]["type"], "wind")
+        saved = data["weather"]["saved"]
+        self.assertEqual([item["forecast"]["current"]["temperature_2m"] for item in saved], [34, 33, 32, 31, 30, 10])
+        self.assertEqual(saved[0]["forecast"]["hourly"]["temperature_2m"], [0, 1, 2, 3, 4, 5])
+
+    def test_one_cache_read_for_all_weather(self):
+        for i in range(5):
+            self.add_location(30 + i, 40)
+        caching._local.clear()
+        with mock.patch.object(cache, "get_many", wraps=cache.get_many) as get_many:
+            response = self.client.get("/api/dashboard")
+        get_many.assert_called_once()
+        self.assertEqual(len(get_many.call_args.args[0]), 5)
+        self.assertEqual(len(response.json()["weather"]["saved"]), 5)
+
+    def test_active_location_from_params(self):
+        self.add_location(10, 20)
+        response = self.client.get("/api/dashboard", {"lat": 10, "lon": 20, "timezone": "UTC", "name": "Here"})
+        self.assertEqual(response.json()["weather"]["active"]["location"]["name"], "Here")
+        self.assertEqual(self.client.get("/api/dashboard", {"lat": "north"}).status_code, 400)
+
+
+@override_settings(CACHES=LOCMEM)
+class SubscriptionMarkerTests(TestCase):
+    payload = {"name": "Here", "lat": 10, "lon": 20, "timezone": "UTC", "types": ["wind"]}
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user("subs", "subs@example.com", "password123"))
+
+    def test_bumped_once_committed(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post("/api/alert-subscriptions", self.payload, format="json")
+            self.assertIsNone(cache.get(SUBSCRIPTIONS_VERSION_KEY))
+        for callback in callbacks:
+            callback()
+        self.assertEqual(cache.get(SUBSCRIPTIONS_VERSION_KEY), 1)
+
+    def test_writes_survive_a_cache_outage(self):
+        with mock.patch.object(cache, "incr", side_effect=ConnectionError("cache down")), \
+                self.assertLogs("weather.signals", "WARNING"), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/api/alert-subscriptions", self.payload, format="json")
+            self.assertEqual(response.status_code, 201)
+            response = self.client.delete(f"/api/alert-subscriptions/{response.json()['id']}")
+        self.assertLess(response.status_code, 300)
+
+
+@override_settings(ALERTS_CHANGE_SKEW_SECONDS=300)
+class DaemonChangeTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("daemon", "daemon@example.com", "password123")
+        self.command = SendAlertsCommand()
+        self.command.shards = self.command.shard_total = None
+        self.command.seen = {}
+        self.queue = DueQueue()
+
+    def subscribe(self, updated_at=None):
+        lat = AlertSubscription.objects.count()
+        sub = AlertSubscription.objects.create(user=self.user, name="Here", lat=lat, lon=20, timezone="UTC")
+        if updated_at is not None:
+            AlertSubscription.objects.filter(id=sub.id).update(updated_at=updated_at)
+        return sub.id
+
+    def test_late_commit_with_an_older_timestamp_is_picked_up_once(self):
+        self.subscribe()
+        watermark = self.command.load_schedule(self.queue)
+        late = self.subscribe(updated_at=watermark - timedelta(seconds=60))
+        self.subscribe(updated_at=watermark - timedelta(seconds=600))
+
+        with mock.patch.object(self.queue, "schedule", wraps=self.queue.schedule) as schedule:
+            self.assertEqual(self.command.schedule_changes(self.queue, watermark), watermark)
+            self.command.schedule_changes(self.queue, watermark)
+        self.assertEqual([call.args[0] for call in schedule.call_args_list], [late])
+
+    def test_edit_inside_the_margin_is_scheduled_again(self):
+        sub_id = self.subscribe()
+        watermark = self.command.load_schedule(self.queue)
+        AlertSubscription.objects.filter(id=sub_id).update(updated_at=watermark + timedelta(seconds=1))
+        with mock.patch.object(self.queue, "schedule", wraps=self.queue.schedule) as schedule:
+            self.assertGreater(self.command.schedule_changes(self.queue, watermark), watermark)
+        schedule.assert_called_once()
+
+
+@override_settings(CACHES=LOCMEM)
+class BatchAdmissionTests(TestCase):
+    body = {"locations": [{"lat": 10, "lon": 20, "timezone": "UTC"}]}
+
+    def setUp(self):
+        cache.clear()
+        caching._local.clear()
+        self.user = User.objects.create_user("batch", "batch@example.com", "password123")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def refused(self):
+        return mock.patch.object(admission.limiter, "acquire", return_value=False)
+
+    def test_refused_batch_serves_stale(self):
+        cache_forecast(10, 20, {"current": {"temperature_2m": 4}}, age=FORECAST_TTL + 60)
+        with self.refused(), mock.patch("weather.forecasts.fetch_forecasts") as fetch:
+            response = self.client.post("/api/weather/batch", self.body, format="json")
+        fetch.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        result = response.json()["results"][0]
+        self.assertTrue(result["stale"])
+        self.assertEqual(result["forecast"]["current"]["temperature_2m"], 4)
+
+    def test_refused_batch_without_cache_is_503(self):
+        with self.refused(), mock.patch("weather.forecasts.fetch_forecasts") as fetch:
+            response = self.client.post("/api/weather/batch", self.body, format="json")
+        fetch.assert_not_called()
+        self.assertEqual(response.status_code, 503)
+        self.assertGreaterEqual(int(response["Retry-After"]), 1)
+
+    def test_refused_dashboard_leaves_weather_out(self):
+        SavedLocation.objects.create(user=self.user, name="Here", lat=10, lon=20, timezone="UTC")
+        with self.refused():
+            response = self.client.get("/api/dashboard")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["saved_locations"]), 1)
+        self.assertEqual(response.json()["weather"]["saved"][0]["detail"], "Service busy, try again shortly")
+
+    def test_admitted_chunk_releases_its_slot(self):
+        forecast = {"current": {"temperature_2m": 9}}
+        with mock.patch("weather.forecasts.fetch_forecasts", return_value=[forecast]), \
+                mock.patch.object(admission.limiter, "release", wraps=admission.limiter.release) as release:
+            response = self.client.post("/api/weather/batch", self.body, format="json")
+        self.assertEqual(response.json()["results"][0]["forecast"]["current"]["temperature_2m"], 9)
+        release.assert_called_once()
+        self.assertIs(release.call_args.args[1], True)
+
+
+@override_settings(CACHES=LOCMEM)
+class ConditionalResponseTests(TestCase):
+    url = "/api/alerts?lat=10&lon=20&timezone=UTC"
+
+    def setUp(self):
+        cache.clear()
+        caching._local.clear()
+
+    def test_max_age_is_the_full_ttl_next_to_age(self):
+        cache_forecast(10, 20, {"current": {"wind_speed_10m": 50}}, age=400)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Cache-Control"], f"public, max-age={FORECAST_TTL}")
+        self.assertEqual(response["Age"], "400")
+        self.assertIn("Accept-Encoding", response["Vary"])
+
+    def test_not_modified_varies_on_accept_encoding(self):
+        cache_forecast(10, 20, {"current": {"wind_speed_10m": 50}})
+        etag = self.client.get(self.url)["ETag"]
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        self.assertIn("Accept-Encoding", response["Vary"])
+
+    def test_if_none_match(self):
+        cache_forecast(10, 20, {"current": {"wind_speed_10m": 50}})
+        etag = self.client.get(self.url)["ETag"]
+        strong = etag.removeprefix("W/")
+        for header, status in [
+            (etag, 304),
+            (strong, 304),
+            (f'W/"other", {etag}', 304),
+            ("*", 304),
+            ('W/"other"', 200),
+        ]:
+            self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=header).status_code, status, header)
+
+    def test_if_modified_since(self):
+        entry = cache_forecast(10, 20, {"current": {"wind_speed_10m": 50}}, age=60)
+        fetched = int(entry["fetched_at"])
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=http_date(fetched))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["Last-Modified"], http_date(fetched))
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=http_date(fetched - 1)).status_code, 200)
+        # If-None-Match wins over If-Modified-Since.
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='W/"other"', HTTP_IF_MODIFIED_SINCE=http_date(fetched))
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(PRERENDERED_RESPONSES=False)
+    def test_not_modified_skips_the_body(self):
+        cache_forecast(10, 20, {"current": {"wind_speed_10m": 50}})
+        with mock.patch.object(codec, "unpack", wraps=codec.unpack) as unpack:
+            etag = self.client.get(self.url)["ETag"]
+            self.assertTrue(unpack.called)
+            unpack.reset_mock()
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        unpack.assert_not_called()
+
+    def test_new_content_gets_a_new_etag(self):
+        cache_forecast(10, 20, {"current": {"wind_speed_10m": 50}})
+        etag = self.client.get(self.url)["ETag"]
+        caching._local.clear()
+        cache_forecast(10, 20, {"current": {"wind_speed_10m": 20}})
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+
+class CodecTests(SimpleTestCase):
+    def round_trip(self, payload, series=True):
+        packed = codec.pack(payload, "compact")
+        self.assertTrue(codec.is_packed(packed))
+        return codec.unpack(packed, series)
+
+    def assertSameJSON(self, first, second):
+        # json.dumps tells 1 from 1.0, which assertEqual does not.
+        self.assertEqual(json.dumps(first), json.dumps(second))
+
+    def test_numbers_and_nulls(self):
+        hourly = {
+            "time": [f"2026-10-18T{h:02d}:00" for h in range(24)],
+            "temperature_2m": [round(-5 + h * 0.37, 1) if h % 7 else None for h in range(24)],
+            "precipitation": [round(h * 0.013, 3) for h in range(24)],
+            "weather_code": [h % 4 if h != 3 else None for h in range(24)],
+            "wind_speed_10m": [float(h) for h in range(24)],
+            "uv_index": [h * 0.1 + 1e-9 for h in range(24)],
+            "big": [2**40 + h for h in range(24)],
+            "scaled_out_of_range": [3e9 + h * 0.5 for h in range(24)],
+        }
+        payload = {"forecast": {"latitude": 48.86, "hourly": hourly, "current": {"time": "2026-10-18T10:00", "temperature_2m": 12.3}}}
+        self.assertSameJSON(self.round_trip(payload), payload)
+
+    def test_mixed_int_and_float_column(self):
+        daily = {
+            "time": ["2026-10-18", "2026-10-19", "2026-10-20"],
+            "precipitation_probability_max": [10, 20.5, None],
+            "sunrise": ["2026-10-18T07:00", "2026-10-19T07:02", "2026-10-20T07:03"],
+            "flags": [True, False, True],
+        }
+        payload = {"forecast": {"daily": daily}}
+        self.assertSameJSON(self.round_trip(payload), payload)
+
+    def test_uneven_time_axis(self):
+        # Local times across a DST change skip an hour.
+        hourly = {
+            "time": ["2026-03-29T00:00", "2026-03-29T01:00", "2026-03-29T03:00", "2026-03-29T04:00"],
+            "temperature_2m": [4.1, 3.9, 3.5, 3.2],
+        }
+        payload = {"forecast": {"hourly": hourly}}
+        self.assertSameJSON(self.round_trip(payload), payload)
+
+    def test_without_series(self):
+        payload = {
+            "forecast": {
+                "current": {"temperature_2m": 12.3},
+                "hourly": {"time": ["2026-10-18T00:00", "2026-10-18T01:00"], "temperature_2m": [1.5, 2.5]},
+            },
+            "alerts": [],
+        }
+        self.assertSameJSON(self.round_trip(payload, series=False), {"forecast": {"current": {"temperature_2m": 12.3}}, "alerts": []})
+
+    def test_unpacked_values_pass_through(self):
+        self.assertEqual(codec.unpack({"a": 1}), {"a": 1})
+        self.assertEqual(codec.pack([1, 2], "compact"), [1, 2])
+        self.assertEqual(codec.pack({"a": 1}, "none"), {"a": 1})
+
+
+@override_settings(
+    CACHES=LOCMEM,
+    UPSTREAM_RATE_LIMITS={},
+    UPSTREAM_BREAKER_FAILURES=3,
+    UPSTREAM_BREAKER_WINDOW_SECONDS=30,
+    UPSTREAM_BREAKER_OPEN_SECONDS=30,
+)
+class BreakerTests(SimpleTestCase):
+    provider = "open_meteo"
+
+    def setUp(self):
+        cache.clear()
+        throttle._tripped.clear()
+        logger = mock.patch.object(throttle, "logger")
+        logger.start()
+        self.addCleanup(logger.stop)
+
+    def fail(self, times):
+        for _ in range(times):
+            throttle.record(self.provider, False)
+
+    def test_a_success_resets_the_failure_count(self):
+        self.fail(2)
+        throttle.record(self.provider, True)
+        self.fail(2)
+        self.assertIsNone(throttle.admit(self.provider))
+        self.assertEqual(throttle.status()[self.provider]["circuit"], "closed")
+
+    def test_consecutive_failures_open_the_circuit(self):
+        self.fail(3)
+        self.assertEqual(throttle.admit(self.provider), throttle.OPEN)
+        self.assertEqual(throttle.status()[self.provider]["circuit"], "open")
+
+    def test_half_open_admits_one_probe(self):
+        self.fail(3)
+        with mock.patch("weather.throttle.time.time", return_value=time.time() + 31):
+            self.assertIsNone(throttle.admit(self.provider))
+            self.assertEqual(throttle.admit(self.provider), throttle.OPEN)
+            throttle.record(self.provider, True)
+            self.assertIsNone(throttle.admit(self.provider))
+        self.assertEqual(throttle.status()[self.provider]["circuit"], "closed")
+
+    def test_failed_probe_reopens(self):
+        self.fail(3)
+        later = time.time() + 31
+        with mock.patch("weather.throttle.time.time", return_value=later):
+            self.assertIsNone(throttle.admit(self.provider))
+            throttle.record(self.provider, False)
+            self.assertEqual(throttle.admit(self.provider), throttle.OPEN)
+
+    def test_async_record_matches(self):
+        async def run():
+            for ok in (False, False, True, False, False):
+                await throttle.arecord(self.provider, ok)
+            self.assertIsNone(await throttle.aadmit(self.provider))
+            await throttle.arecord(self.provider, False)
+            self.assertEqual(await throttle.aadmit(self.provider), throttle.OPEN)
+
+        asyncio.run(run())
+
+
+@override_settings(CACHES=LOCMEM, UPSTREAM_RATE_LIMITS={"nominatim": (2, 1.0)}, UPSTREAM_RATE_WAIT_SECONDS=0)
+class RateBudgetTests(SimpleTestCase):
+    provider = "nominatim"
+
+    def setUp(self):
+        throttle._buckets.clear()
+
+    def test_burst_up_to_capacity_then_refill(self):
+        with mock.patch("weather.throttle.time.monotonic", return_value=100.0) as clock:
+            self.assertIsNone(throttle.spend(self.provider))
+            self.assertIsNone(throttle.spend(self.provider))
+            self.assertEqual(throttle.spend(self.provider), throttle.RATE)
+            clock.return_value = 100.5
+            self.assertIsNone(throttle.spend(self.provider))
+            self.assertEqual(throttle.spend(self.provider), throttle.RATE)
+        self.assertIn("0.0 of 2", throttle.status()[self.provider]["rate"])
+
+    def test_waits_for_a_token_within_the_limit(self):
+        clock = [100.0]
+
+        def advance(seconds):
+            clock[0] += seconds
+
+        with mock.patch("weather.throttle.time.monotonic", side_effect=lambda: clock[0]), \
+                mock.patch("weather.throttle.time.sleep", side_effect=advance) as sleep, \
+                self.settings(UPSTREAM_RATE_WAIT_SECONDS=1):
+            throttle.spend(self.provider)
+            throttle.spend(self.provider)
+            self.assertIsNone(throttle.spend(self.provider))
+        sleep.assert_called_once_with(0.5)
+
+    def test_unlimited_provider_is_never_throttled(self):
+        for _ in range(10):
+            self.assertIsNone(throttle.spend("google"))
+
+
+class PrefixIndexTests(SimpleTestCase):
+    def places(self, count):
+        return [
+            {"name": f"Place {(i * 7919) % count:05d}", "lat": i / 100, "lon": 0.0, "population": i}
+            for i in range(count)
+        ]
+
+    def test_bulk_load_matches_one_by_one(self):
+        places = self.places(INSERT_LIMIT * 3)
+        one_by_one, bulk = PrefixIndex(), PrefixIndex()
+        for place in places:
+            one_by_one.add(place)
+        bulk.add_many(places[:INSERT_LIMIT // 2])
+        bulk.add_many(places[INSERT_LIMIT // 2:])
+        self.assertEqual(bulk._keys, sorted(bulk._keys))
+        self.assertEqual(bulk._places, one_by_one._places)
+
+    def test_duplicates_and_incomplete_places_are_skipped(self):
+        index = PrefixIndex()
+        index.add_many(self.places(INSERT_LIMIT + 1) * 2 + [{"name": "Nowhere", "lat": None, "lon": 1}])
+        self.assertEqual(len(index), INSERT_LIMIT + 1)
+        self.assertEqual(index.search("nowhere"), [])
+
+    def test_search_folds_and_ranks_by_population(self):
+        index = PrefixIndex()
+        index.add_many([
+            {"name": "São Paulo", "lat": -23.55, "lon": -46.63, "population": 12000000},
+            {"name": "Santos", "lat": -23.96, "lon": -46.33, "population": 430000},
+            {"name": "Sapporo", "lat": 43.06, "lon": 141.35, "population": 1900000},
+        ])
+        self.assertEqual([p["name"] for p in index.search("SA")], ["São Paulo", "Sapporo", "Santos"])
+        self.assertEqual([p["name"] for p in index.search("sao p")], ["São Paulo"])
+
+
+def legacy_alerts(forecast):
+    """The hard-coded checks build_alerts replaced, kept to pin the rule table to them."""
+    current = forecast.get("current") or {}
+    hourly = forecast.get("hourly") or {}
+    daily = forecast.get("daily") or {}
+    alerts = []
+
+    def check(type_, value, passes, levels):
+        if value is None:
+            return
+        for severity, threshold, title, detail in levels:
+            if passes(value, threshold):
+                alerts.append({"type": type_, "severity": severity, "title": title, "detail": detail})
+                return
+
+    def first(key):
+        return (daily.get(key) or [None])[0]
+
+    ge, le = (lambda a, b: a >= b), (lambda a, b: a <= b)
+    pmax, tmin, tmax = first("precipitation_probability_max"), first("temperature_2m_min"), first("temperature_2m_max")
+    wind, uv = current.get("wind_speed_10m"), current.get("uv_index")
+    check("rain", pmax, ge, [
+        ("warning", 80, "Rain very likely today", f"Chance of precipitation is {pmax}%."),
+        ("info", 60, "Rain possible today", f"Chance of precipitation is {pmax}%."),
+    ])
+    if wind is not None:
+        check("wind", wind, ge, [
+            ("warning", 45, "Strong winds", f"Current wind speed is ~{round(wind)} km/h."),
+            ("info", 30, "Breezy conditions", f"Current wind speed is ~{round(wind)} km/h."),
+        ])
+    check("uv", uv, ge, [
+        ("warning", 8, "High UV", f"UV index is {uv}. Consider sunscreen and shade."),
+        ("info", 6, "Moderate/High UV", f"UV index is {uv}. Protection recommended."),
+    ])
+    if tmin is not None:
+        check("freeze", tmin, le, [
+            ("warning", -5, "Freezing risk overnight", f"Low is ~{round(tmin)}°C."),
+            ("info", 0, "Near-freezing temperatures", f"Low is ~{round(tmin)}°C."),
+        ])
+    if tmax is not None:
+        check("heat", tmax, ge, [
+            ("warning", 32, "Heat risk", f"High is ~{round(tmax)}°C. Stay hydrated."),
+            ("info", 28, "Warm day", f"High is ~{round(tmax)}°C."),
+        ])
+
+    probs, times = hourly.get("precipitation_probability") or [], hourly.get("time") or []
+    if len(probs) >= 12 and len(times) >= 12:
+        for i in range(12):
+            if (probs[i] or 0) >= 70:
+                alerts.append({
+                    "type": "rain",
+                    "severity": "warning",
+                    "title": "Rain likely soon",
+                    "detail": f"High precipitation probability around {times[i].replace('T', ' ')} ({probs[i]}%).",
+                })
+                break
+    return alerts
+
+
+class AlertRuleTests(SimpleTestCase):
+    def random_forecast(self, rnd):
+        def maybe(value):
+            return value if rnd.random() < 0.85 else None
+
+        def daily(low, high):
+            return [rnd.choice([rnd.randint(low, high), round(rnd.uniform(low, high), 1)]) for _ in range(rnd.choice([0, 1, 3]))]
+
+        hours = rnd.choice([0, 11, 12, 24])
+        current = {"wind_speed_10m": maybe(rnd.choice([30, 45, round(rnd.uniform(0, 70), 1)])),
+                   "uv_index": maybe(rnd.choice([6, 8, round(rnd.uniform(0, 11), 2)]))}
+        return {
+            "current": {key: value for key, value in current.items() if value is not None},
+            "daily": {
+                "precipitation_probability_max": daily(40, 100),
+                "temperature_2m_min": daily(-10, 5),
+                "temperature_2m_max": daily(20, 40),
+            },
+            "hourly": {
+                "time": [f"2026-10-18T{h % 24:02d}:00" for h in range(rnd.choice([hours, 12]))],
+                "precipitation_probability": [maybe(rnd.choice([69, 70, rnd.randint(0, 100)])) for _ in range(hours)],
+            },
+        }
+
+    def test_matches_the_hard_coded_thresholds(self):
+        rnd = random.Random(15)
+        for _ in range(2000):
+            forecast = self.random_forecast(rnd)
+            self.assertEqual(build_alerts(forecast), legacy_alerts(forecast), forecast)
+
+    def test_boundaries(self):
+        cases = [
+            ({"daily": {"precipitation_probability_max": [60, 0]}}, [("rain", "info")]),
+            ({"daily": {"precipitation_probability_max": [59]}}, []),
+            ({"daily": {"precipitation_probability_max": [80]}}, [("rain", "warning")]),
+            ({"current": {"wind_speed_10m": 29.9, "uv_index": 8}}, [("uv", "warning")]),
+            ({"daily": {"temperature_2m_min": [0], "temperature_2m_max": [28]}}, [("freeze", "info"), ("heat", "info")]),
+            ({"daily": {"temperature_2m_min": [-5], "temperature_2m_max": [32]}}, [("freeze", "warning"), ("heat", "warning")]),
+            ({"hourly": {"time": ["t"] * 12, "precipitation_probability": [0] * 11 + [70, 100]}}, [("rain", "warning")]),
+            ({"hourly": {"time": ["t"] * 12, "precipitation_probability": [0] * 12 + [100]}}, []),
+            ({"hourly": {"time": ["t"] * 11, "precipitation_probability": [100] * 12}}, []),
+            ({}, []),
+        ]
+        for forecast, expected in cases:
+            self.assertEqual([(a["type"], a["severity"]) for a in build_alerts(forecast)], expected, forecast)
+
+    def test_overrides_replace_only_the_given_levels(self):
+        forecast = {"current": {"wind_speed_10m": 40}, "daily": {"precipitation_probability_max": [70]}}
+        self.assertEqual(build_alerts(forecast, {"wind": {"warning": 38}})[1]["severity"], "warning")
+        self.assertEqual([a["type"] for a in build_alerts(forecast, {"wind": {"info": 41}})], ["rain"])
+        self.assertEqual(build_alerts(forecast, {"rain": {"warning": 65}})[0]["title"], "Rain very likely today")
+        self.assertEqual(build_alerts(forecast, {}), build_alerts(forecast))
+
+    def test_validate_thresholds(self):
+        base = {"name": "Here", "lat": 10, "lon": 20, "types": ["wind"]}
+        valid = [{}, {"wind": {"warning": 50, "info": 35.5}}, {"rain_soon": {"warning": 90}}]
+        invalid = [[], {"hail": {"warning": 1}}, {"wind": 50}, {"wind": {"severe": 50}}, {"wind": {"warning": "50"}},
+                   {"wind": {"warning": True}}]
+        for thresholds in valid:
+            self.assertTrue(AlertSubscriptionSerializer(data={**base, "thresholds": thresholds}).is_valid(), thresholds)
+        for thresholds in invalid:
+            ser = AlertSubscriptionSerializer(data={**base, "thresholds": thresholds})
+            self.assertFalse(ser.is_valid(), thresholds)
+            self.assertIn("thresholds", ser.errors)
+
+
+@override_settings(CACHES=LOCMEM, SINGLE_FLIGHT_POLL_SECONDS=0.01)
+class SingleFlightTests(SimpleTestCase):
+    key = "test:single-flight"
+
+    def setUp(self):
+        cache.clear()
+        caching._local.clear()
+
+    def test_concurrent_misses_fill_once(self):
+        calls = []
+
+        async def fill():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return {"n": 1}
+
+        async def run():
+            return await asyncio.gather(*(caching.aget_or_fill(self.key, fill, 60) for _ in range(5)))
+
+        results = asyncio.run(run())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([value for value, _ in results], [{"n": 1}] * 5)
+        self.assertEqual(sorted(info["cached"] for _, info in results), [False, True, True, True, True])
+        self.assertIsNone(cache.get(caching._lock_key(self.key)))
+
+    def test_a_waiter_takes_over_when_the_leader_fails(self):
+        calls = []
+
+        async def fill():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            if len(calls) == 1:
+                raise RuntimeError("upstream down")
+            return {"n": 2}
+
+        async def run():
+            return await asyncio.gather(
+                *(caching.aget_or_fill(self.key, fill, 60) for _ in range(3)), return_exceptions=True
+            )
+
+        results = asyncio.run(run())
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(sum(isinstance(result, RuntimeError) for result in results), 1)
+        self.assertEqual([r[0] for r in results if not isinstance(r, Exception)], [{"n": 2}, {"n": 2}])
+
+    @override_settings(SINGLE_FLIGHT_WAIT_SECONDS=0.1)
+    def test_waiting_out_a_busy_leader(self):
+        cache.add(caching._lock_key(self.key), "another worker")
+        fill = mock.AsyncMock(return_value={"n": 2})
+        with self.assertRaises(admission.Overloaded):
+            asyncio.run(caching.aget_or_fill(self.key, fill, 60))
+
+        # Past hard_until, so it is only served because the wait ran out.
+        store(self.key, {"n": 1}, age=60 + 3600)
+        value, info = asyncio.run(caching.aget_or_fill(self.key, fill, 60))
+        self.assertEqual((value, info["stale"]), ({"n": 1}, True))
+        fill.assert_not_called()
+
+    @override_settings(SINGLE_FLIGHT_LOCK_SECONDS=0.3)
+    def test_lock_is_kept_for_a_slow_fill(self):
+        lock_key = caching._lock_key(self.key)
+        held = []
+
+        async def fill():
+            await asyncio.sleep(0.6)
+            held.append(await cache.aget(lock_key))
+            return {"n": 1}
+
+        asyncio.run(caching.aget_or_fill(self.key, fill, 60))
+        self.assertIsNotNone(held[0])
+        self.assertIsNone(cache.get(lock_key))
+
+
+@override_settings(CACHES=LOCMEM, CACHE_STALE_GRACE_SECONDS=1800)
+class StaleWhileRevalidateTests(SimpleTestCase):
+    key = "test:swr"
+
+    def setUp(self):
+        cache.clear()
+        caching._local.clear()
+
+    def test_fresh_hit_skips_fill(self):
+        store(self.key, {"n": 1}, age=10)
+        fill = mock.AsyncMock()
+        value, info = asyncio.run(caching.aget_or_fill(self.key, fill, 60))
+        self.assertEqual(value, {"n": 1})
+        self.assertEqual((info["cached"], info["stale"], info["age"], info["lifetime"]), (True, False, 10, 60))
+        fill.assert_not_called()
+
+    def test_soft_expired_is_served_at_once_and_refreshed_behind(self):
+        store(self.key, {"n": 1}, age=61)
+
+        async def fill():
+            return {"n": 2}
+
+        value, info = asyncio.run(caching.aget_or_fill(self.key, fill, 60))
+        self.assertEqual((value, info["stale"]), ({"n": 1}, True))
+        deadline = time.monotonic() + 2
+        while caching.payload(cache.get(self.key)) != {"n": 2} and time.monotonic() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(caching.payload(cache.get(self.key)), {"n": 2})
+
+    def test_hard_expired_waits_for_the_refetch(self):
+        store(self.key, {"n": 1}, age=60 + 1800 + 1)
+        value, info = asyncio.run(caching.aget_or_fill(self.key, mock.AsyncMock(return_value={"n": 2}), 60))
+        self.assertEqual((value, info["cached"], info["stale"]), ({"n": 2}, False, False))
+
+    def test_failed_refetch_serves_the_last_good_value(self):
+        store(self.key, {"n": 1}, age=60 + 1800 + 1)
+        fill = mock.AsyncMock(side_effect=RuntimeError("upstream down"))
+        with self.assertLogs("weather.caching", "WARNING"):
+            value, info = asyncio.run(caching.aget_or_fill(self.key, fill, 60))
+        self.assertEqual((value, info["stale"], info["lifetime"]), ({"n": 1}, True, 0))
+
+    def test_nothing_to_cache(self):
+        self.assertEqual(asyncio.run(caching.aget_or_fill(self.key, mock.AsyncMock(return_value=None), 60)), (None, None))
+        self.assertIsNone(cache.get(self.key))
+
+    def test_envelope_windows(self):
+        entry = caching.envelope({"n": 1}, 60, fetched_at=1000.0)
+        self.assertEqual((entry["soft_until"], entry["hard_until"]), (1060.0, 2860.0))
+        self.assertEqual(entry["digest"], caching.envelope({"n": 1}, 30)["digest"])
+        self.assertNotEqual(entry["digest"], caching.envelope({"n": 2}, 60)["digest"])
+
+
+class AdaptiveLimiterTests(SimpleTestCase):
+    def limiter(self, initial=2):
+        return admission.AdaptiveLimiter(initial, minimum=1, maximum=4, target=1.0, backoff=0.5)
+
+    def test_refuses_over_the_cap(self):
+        limiter = self.limiter()
+        self.assertTrue(limiter.acquire())
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())
+        limiter.release(0.1, True)
+        self.assertTrue(limiter.acquire())
+        self.assertEqual(limiter.snapshot()["shed"], 1)
+
+    def test_grows_with_fast_calls_up_to_the_maximum(self):
+        limiter = self.limiter()
+        for _ in range(50):
+            limiter.acquire()
+            limiter.release(0.1, True)
+        self.assertEqual(limiter.snapshot()["limit"], 4)
+
+    def test_backs_off_once_per_observed_latency(self):
+        limiter = self.limiter(initial=4)
+        with mock.patch("weather.admission.time.monotonic", return_value=1000.0) as clock:
+            for _ in range(3):
+                limiter.acquire()
+                limiter.release(2.0, True)
+            self.assertEqual(limiter.limit, 2)
+            clock.return_value = 1002.0
+            limiter.acquire()
+            limiter.release(0.1, False)
+            self.assertEqual(limiter.limit, 1)
+            limiter.acquire()
+            limiter.release(5.0, False)
+        self.assertEqual(limiter.limit, 1)
+
+    def test_retry_after_follows_latency(self):
+        limiter = self.limiter()
+        self.assertEqual(limiter.retry_after(), 1)
+        limiter.acquire()
+        limiter.release(2.5, True)
+        self.assertEqual(limiter.retry_after(), 3)
+
+
+@override_settings(CACHES=LOCMEM)
+class RefetchAdmissionTests(SimpleTestCase):
+    key = "test:admission"
+
+    def setUp(self):
+        cache.clear()
+        caching._local.clear()
+        refused = mock.patch.object(admission.limiter, "acquire", return_value=False)
+        refused.start()
+        self.addCleanup(refused.stop)
+
+    def test_refused_refetch_serves_the_previous_value(self):
+        store(self.key, {"n": 1}, age=60 + 3600)
+        fill = mock.AsyncMock(return_value={"n": 2})
+        with self.assertLogs("weather.caching", "WARNING"):
+            value, info = asyncio.run(caching.aget_or_fill(self.key, fill, 60))
+        self.assertEqual((value, info["stale"]), ({"n": 1}, True))
+        fill.assert_not_called()
+        self.assertIsNone(cache.get(caching._lock_key(self.key)))
+
+    def test_refused_refetch_without_a_value(self):
+        with self.assertRaises(admission.Overloaded) as raised:
+            asyncio.run(caching.aget_or_fill(self.key, mock.AsyncMock(), 60))
+        self.assertEqual(raised.exception.retry_after, admission.limiter.retry_after())
+
+    def test_async_views_answer_503(self):
+        response = self.client.get("/api/alerts?lat=10&lon=20&timezone=UTC")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], str(admission.limiter.retry_after()))
+        cache_forecast(10, 20, {"current": {"wind_speed_10m": 50}}, age=FORECAST_TTL + 3600)
+        with self.assertLogs("weather.caching", "WARNING"):
+            response = self.client.get("/api/alerts?lat=10&lon=20&timezone=UTC")
+        self.assertEqual((response.status_code, response["X-Cache"]), (200, "STALE"))
+
+
+@override_settings(CACHES=LOCMEM, SENDGRID_API_KEY="test", ALERTS_FROM_EMAIL="alerts@example.com")
+class SendAlertsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        caching._local.clear()
+        client = mock.patch("weather.management.commands.send_alerts.SendGridAPIClient")
+        self.send = client.start().return_value.send
+        self.addCleanup(client.stop)
+
+    def subscribe(self, username, lat=10, lon=20, **fields):
+        user = User.objects.create_user(username, f"{username}@example.com", "password123")
+        return AlertSubscription.objects.create(user=user, name=username, lat=lat, lon=lon, timezone="UTC", **fields)
+
+    def run_command(self, *args):
+        out = io.StringIO()
+        call_command("send_alerts", *args, stdout=out)
+        return out.getvalue()
+
+    def recipients(self):
+        return sorted(call.args[0].personalizations[0].tos[0]["email"] for call in self.send.call_args_list)
+
+
+class SendAlertsDedupTests(SendAlertsTestCase):
+    def test_same_alerts_are_sent_once(self):
+        sub = self.subscribe("alice")
+        cache_forecast(10, 20, {"current": {"wind_speed_10m": 50}})
+        self.run_command()
+        self.run_command()
+        self.assertEqual(self.send.call_count, 1)
+        sub.refresh_from_db()
+        self.assertTrue(sub.last_alert_hash)
+        self.assertIsNotNone(sub.last_sent_at)
+
+        caching._local.clear()
+        cache_forecast(10, 20, {"current": {"wind_speed_10m": 35}})
+        self.run_command()
+        self.assertEqual(self.send.call_count, 2)
+
+    def test_shared_cell_with_per_subscription_filters(self):
+        self.subscribe("alice")
+        self.subscribe("bob", thresholds={"wind": {"warning": 60, "info": 55}})
+        self.subscribe("carol", types=["rain"])
+        self.subscribe("dave", min_severity="warning", lat=10.0001)
+        cache_forecast(10, 20, {"current": {"wind_speed_10m": 40}})
+        with mock.patch("weather.forecasts.fetch_forecasts") as fetch:
+            self.run_command()
+        fetch.assert_not_called()
+        self.assertEqual(self.recipients(), ["alice@example.com"])
+
+    def test_failed_send_is_retried_next_run(self):
+        sub = self.subscribe("alice")
+        cache_forecast(10, 20, {"current": {"wind_speed_10m": 50}})
+        self.send.side_effect = [RuntimeError("sendgrid down"), None]
+        self.assertIn("Send failed for alice@example.com", self.run_command())
+        sub.refresh_from_db()
+        self.assertEqual(sub.last_alert_hash, "")
+        self.run_command()
+        self.assertEqual(self.send.call_count, 2)
+
+    def test_stale_forecasts_are_not_sent(self):
+        self.subscribe("alice")
+        cache_forecast(10, 20, {"current": {"wind_speed_10m": 50}}, age=FORECAST_TTL + 60)
+        def fetch_forecasts(coords, timezone):
+            raise requests.ConnectionError("upstream down")
+
+        with mock.patch("weather.forecasts.fetch_forecasts", fetch_forecasts), self.assertLogs("weather.caching", "WARNING"):
+            output = self.run_command()
+        self.assertIn("Fetch failed for alice", output)
+        self.send.assert_not_called()
+
+
+class SendAlertsLeaseTests(SendAlertsTestCase):
+    def command(self, shard=None):
+        command = SendAlertsCommand(stdout=io.StringIO())
+        command.owner = leases.new_owner()
+        command.now = timezone.now()
+        command.shard_index, command.shard_total = shard or (None, None)
+        command.shards = None if shard is None else set()
+        return command
+
+    def test_send_lease_held_elsewhere_skips_the_send(self):
+        sub = self.subscribe("alice")
+        cache_forecast(10, 20, {"current": {"wind_speed_10m": 50}})
+        leases.acquire(send_lease_key(sub.id), "other worker", 60)
+        self.run_command()
+        self.send.assert_not_called()
+        self.assertEqual(cache.get(send_lease_key(sub.id)), "other worker")
+
+    def test_send_leases_are_released(self):
+        sub = self.subscribe("alice")
+        cache_forecast(10, 20, {"current": {"wind_speed_10m": 50}})
+        self.run_command()
+        self.send.assert_called_once()
+        self.assertIsNone(cache.get(send_lease_key(sub.id)))
+
+    def test_rows_sent_by_another_worker_are_rechecked_under_the_lease(self):
+        sub = self.subscribe("alice")
+        alerts = build_alerts({"current": {"wind_speed_10m": 50}})
+        command = self.command()
+        AlertSubscription.objects.filter(id=sub.id).update(last_alert_hash=hash_alerts(alerts), last_sent_at=command.now)
+        leased = []
+        self.assertEqual(command.lease_sends([(sub, alerts, hash_alerts(alerts))], leased), [])
+        self.assertEqual(leased, [sub.id])
+
+    def test_fixed_shards_partition_by_id(self):
+        ids = [self.subscribe(f"user{i}", lat=10 + i).id for i in range(4)]
+        for i in range(4):
+            cache_forecast(10 + i, 20, {"current": {"wind_speed_10m": 50}})
+        self.assertEqual(sorted(sub.id for sub in subscription_queryset({1}, 2)), [i for i in ids if i % 2 == 1])
+
+        self.run_command("--shard", "1/2")
+        expected = sorted(f"user{n}@example.com" for n, i in enumerate(ids) if i % 2 == 1)
+        self.assertEqual(self.recipients(), expected)
+        self.assertIsNone(cache.get(shard_lease_key(1, 2)))
+
+    def test_held_shard_skips_the_run(self):
+        self.subscribe("alice")
+        cache_forecast(10, 20, {"current": {"wind_speed_10m": 50}})
+        leases.acquire(shard_lease_key(0, 1), "other worker", 60)
+        self.assertIn("Shard lease is held by another worker", self.run_command("--shard", "0/1"))
+        self.send.assert_not_called()
+
+    def test_auto_shards_are_taken_over_when_freed(self):
+        first, second = self.command((None, 2)), self.command((None, 2))
+        self.assertEqual(first.claim_shards(), [0, 1])
+        self.assertEqual(second.claim_shards(), [])
+        self.assertTrue(first.renew_shards())
+
+        cache.delete(shard_lease_key(1, 2))  # as if the lease had expired
+        self.assertEqual(second.claim_shards(), [1])
+        self.assertFalse(first.renew_shards())
+        self.assertEqual(first.shards, {0})
+        first.release_shards()
+        self.assertEqual(second.claim_shards(), [0])
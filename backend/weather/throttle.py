@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+from .cache_keys import breaker_key, rate_key
+
+logger = logging.getLogger(__name__)
+
+OPEN = "open"
+RATE = "rate"
+
+# Providers whose circuit this process has seen tripped, so a success only
+# clears the open and probe keys while there is something to reset.
+_tripped = set()
+
+
+# ---------- rate budget ----------
+# UPSTREAM_RATE_LIMITS gives each provider a token bucket holding up to
+# `count` calls and refilled at count/seconds calls per second, so no span of
+# `seconds` ever sees more than about `count` calls (a fixed window would
+# allow twice that across a boundary). With Redis behind the cache the bucket
+# is one hash shared by every worker, updated atomically by a Lua script on
+# the server's clock; any other backend is per process anyway, so the bucket
+# is kept in memory under a lock.
+
+_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+local tokens = tonumber(state[1]) or capacity
+local stamp = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - stamp) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'stamp', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+_script = None
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def _on_redis() -> bool:
+    return settings.CACHES["default"]["BACKEND"].startswith("django_redis.")
+
+
+def _redis_take(provider: str, rate: float, capacity: int) -> float:
+    global _script
+    if _script is None:
+        from django_redis import get_redis_connection
+
+        _script = get_redis_connection("default").register_script(_BUCKET_SCRIPT)
+    return float(_script(keys=[rate_key(provider)], args=[rate, capacity]))
+
+
+def _local_take(provider: str, rate: float, capacity: int) -> float:
+    now = time.monotonic()
+    with _buckets_lock:
+        tokens, stamp = _buckets.get(provider, (capacity, now))
+        tokens = min(capacity, tokens + (now - stamp) * rate)
+        if tokens >= 1:
+            _buckets[provider] = (tokens - 1, now)
+            return 0.0
+        _buckets[provider] = (tokens, now)
+    return (1 - tokens) / rate
+
+
+def _take(provider: str) -> float:
+    """Spend one call from the budget; returns 0, or seconds until a call is available."""
+    if provider not in settings.UPSTREAM_RATE_LIMITS:
+        return 0.0
+    count, seconds = settings.UPSTREAM_RATE_LIMITS[provider]
+    take = _redis_take if _on_redis() else _local_take
+    return take(provider, count / seconds, count)
+
+
+_atake = sync_to_async(_take)
+
+
+def _tokens(provider: str):
+    """Calls left in the bucket as of its last use (None until first used)."""
+    if _on_redis():
+        from django_redis import get_redis_connection
+
+        tokens = get_redis_connection("default").hget(rate_key(provider), "tokens")
+        return None if tokens is None else float(tokens)
+    with _buckets_lock:
+        state = _buckets.get(provider)
+    return None if state is None else state[0]
+
+
+# ---------- circuit breaker ----------
+# UPSTREAM_BREAKER_FAILURES consecutive failed calls open a provider's circuit
+# for UPSTREAM_BREAKER_OPEN_SECONDS. Any success resets the count, and so does
+# UPSTREAM_BREAKER_WINDOW_SECONDS passing since the first failure, so a
+# provider that fails now and then never trips it. The "open" key holds the
+# time it may close and outlives it, which marks the half-open state: one
+# worker's call goes through as a probe (claimed with cache.add) while the
+# rest keep failing fast. A failed probe reopens the circuit, a successful one
+# closes it.
+
+def _keys(provider: str):
+    return breaker_key(provider, "open"), breaker_key(provider, "probe"), breaker_key(provider, "failures")
+
+
+def _half_open_ttl() -> int:
+    return settings.UPSTREAM_BREAKER_OPEN_SECONDS * 10
+
+
+def _blocked(provider: str, open_until) -> bool:
+    if open_until is None:
+        return False
+    _tripped.add(provider)
+    if time.time() < open_until:
+        return True
+    return not cache.add(_keys(provider)[1], 1, timeout=settings.UPSTREAM_BREAKER_OPEN_SECONDS)
+
+
+async def _ablocked(provider: str, open_until) -> bool:
+    if open_until is None:
+        return False
+    _tripped.add(provider)
+    if time.time() < open_until:
+        return True
+    return not await cache.aadd(_keys(provider)[1], 1, timeout=settings.UPSTREAM_BREAKER_OPEN_SECONDS)
+
+
+def _open(provider: str):
+    open_key, probe_key, failures_key = _keys(provider)
+    cache.set(open_key, time.time() + settings.UPSTREAM_BREAKER_OPEN_SECONDS, timeout=_half_open_ttl())
+    cache.delete_many([probe_key, failures_key])
+    _tripped.add(provider)
+    logger.warning("Circuit open for %s for %ss", provider, settings.UPSTREAM_BREAKER_OPEN_SECONDS)
+
+
+async def _aopen(provider: str):
+    open_key, probe_key, failures_key = _keys(provider)
+    await cache.aset(open_key, time.time() + settings.UPSTREAM_BREAKER_OPEN_SECONDS, timeout=_half_open_ttl())
+    await cache.adelete_many([probe_key, failures_key])
+    _tripped.add(provider)
+    logger.warning("Circuit open for %s for %ss", provider, settings.UPSTREAM_BREAKER_OPEN_SECONDS)
+
+
+# ---------- public API ----------
+
+def spend(provider: str):
+    """
+    Take one call from the provider's budget, waiting for it when one comes
+    free within UPSTREAM_RATE_WAIT_SECONDS. Returns None, or RATE when the
+    call must not be sent. Retries are charged through this too.
+    """
+    wait = _take(provider)
+    if wait and wait <= settings.UPSTREAM_RATE_WAIT_SECONDS:
+        time.sleep(wait)
+        wait = _take(provider)
+    return RATE if wait else None
+
+
+async def aspend(provider: str):
+    wait = await _atake(provider)
+    if wait and wait <= settings.UPSTREAM_RATE_WAIT_SECONDS:
+        await asyncio.sleep(wait)
+        wait = await _atake(provider)
+    return RATE if wait else None
+
+
+def admit(provider: str):
+    """
+    Called before each upstream call. Returns None when it may go ahead, or
+    OPEN / RATE when it must not be sent.
+    """
+    if _blocked(provider, cache.get(_keys(provider)[0])):
+        return OPEN
+    return spend(provider)
+
+
+async def aadmit(provider: str):
+    if await _ablocked(provider, await cache.aget(_keys(provider)[0])):
+        return OPEN
+    return await aspend(provider)
+
+
+def record(provider: str, ok: bool):
+    """Outcome of an admitted call: a response outside RETRY_STATUSES, or not."""
+    open_key, probe_key, failures_key = _keys(provider)
+    if ok:
+        if provider in _tripped:
+            _tripped.discard(provider)
+            cache.delete_many([open_key, probe_key, failures_key])
+        else:
+            cache.delete(failures_key)
+        return
+    if cache.get(open_key) is not None:
+        _open(provider)
+        return
+    cache.add(failures_key, 0, timeout=settings.UPSTREAM_BREAKER_WINDOW_SECONDS)
+    try:
+        failures = cache.incr(failures_key)
+    except ValueError:
+        return
+    if failures >= settings.UPSTREAM_BREAKER_FAILURES:
+        _open(provider)
+
+
+async def arecord(provider: str, ok: bool):
+    open_key, probe_key, failures_key = _keys(provider)
+    if ok:
+        if provider in _tripped:
+            _tripped.discard(provider)
+            await cache.adelete_many([open_key, probe_key, failures_key])
+        else:
+            await cache.adelete(failures_key)
+        return
+    if await cache.aget(open_key) is not None:
+        await _aopen(provider)
+        return
+    await cache.aadd(failures_key, 0, timeout=settings.UPSTREAM_BREAKER_WINDOW_SECONDS)
+    try:
+        failures = await cache.aincr(failures_key)
+    except ValueError:
+        return
+    if failures >= settings.UPSTREAM_BREAKER_FAILURES:
+        await _aopen(provider)
+
+
+def status() -> dict:
+    """Shared breaker state and rate budget per provider."""
+    result = {}
+    for provider in settings.UPSTREAM_TIMEOUTS:
+        open_key, _, failures_key = _keys(provider)
+        values = cache.get_many([open_key, failures_key])
+        open_until = values.get(open_key)
+        state = "closed" if open_until is None else "open" if time.time() < open_until else "half-open"
+        budget = None
+        if provider in settings.UPSTREAM_RATE_LIMITS:
+            count, seconds = settings.UPSTREAM_RATE_LIMITS[provider]
+            tokens = _tokens(provider)
+            budget = f"{count if tokens is None else tokens:.1f} of {count} per {seconds:g}s left"
+        result[provider] = {"circuit": state, "failures": values.get(failures_key) or 0, "rate": budget}
+    return result
@@ -0,0 +1,206 @@
+import asyncio
+import random
+import threading
+import weakref
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, ResponseError
+from urllib3.util.retry import Retry
+
+from . import throttle
+
+OPEN_METEO = "open_meteo"
+NOMINATIM = "nominatim"
+GOOGLE = "google"
+NEWSAPI = "newsapi"
+
+USER_AGENT = "WeatherPulse/1.0"
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Longest Retry-After honoured before retrying; anything longer is clamped.
+MAX_RETRY_AFTER = 30.0
+
+
+class Unavailable(requests.ConnectionError):
+    """Not sent: the provider's circuit is open or its rate budget is spent."""
+
+
+class AsyncUnavailable(httpx.TransportError):
+    """aget() counterpart of Unavailable, so httpx error handling covers it."""
+
+
+_sessions = {}
+_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+
+
+class _Retry(Retry):
+    """
+    urllib3 Retry that charges every retry against its provider's rate budget,
+    giving up when the budget is spent, and never sleeps longer than
+    MAX_RETRY_AFTER on Retry-After.
+    """
+
+    provider = None
+
+    def new(self, **kw):
+        retry = super().new(**kw)
+        retry.provider = self.provider
+        return retry
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        retry = super().increment(method, url, response, error, _pool, _stacktrace)
+        if self.provider and throttle.spend(self.provider):
+            reason = error or ResponseError(_refused(self.provider, throttle.RATE))
+            raise MaxRetryError(_pool, url, reason) from reason
+        return retry
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, MAX_RETRY_AFTER)
+
+
+def _retry(provider: str):
+    retry = _Retry(
+        total=settings.UPSTREAM_MAX_RETRIES,
+        connect=settings.UPSTREAM_MAX_RETRIES,
+        read=settings.UPSTREAM_MAX_RETRIES,
+        status=settings.UPSTREAM_MAX_RETRIES,
+        backoff_factor=settings.UPSTREAM_BACKOFF_FACTOR,
+        backoff_jitter=settings.UPSTREAM_BACKOFF_JITTER,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset({"GET"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    retry.provider = provider
+    return retry
+
+
+def _build_session(provider: str):
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=settings.UPSTREAM_POOL_CONNECTIONS,
+        pool_maxsize=settings.UPSTREAM_POOL_MAXSIZE,
+        max_retries=_retry(provider),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+
+def session_for(provider: str) -> requests.Session:
+    """
+    One keep-alive session per provider. urllib3 keeps a separate connection
+    pool per host inside it, so sockets are reused across requests and threads.
+    """
+    session = _sessions.get(provider)
+    if session is None:
+        with _lock:
+            session = _sessions.get(provider)
+            if session is None:
+                session = _build_session(provider)
+                _sessions[provider] = session
+    return session
+
+
+def timeout_for(provider: str):
+    read = settings.UPSTREAM_TIMEOUTS.get(provider, settings.UPSTREAM_DEFAULT_TIMEOUT)
+    return (settings.UPSTREAM_CONNECT_TIMEOUT, read)
+
+
+def _refused(provider: str, reason: str) -> str:
+    if reason == throttle.OPEN:
+        return f"{provider} circuit is open"
+    return f"{provider} rate budget exhausted"
+
+
+def get(provider: str, url: str, params=None, headers=None):
+    """
+    GET through the provider's session. Calls are admitted by the shared rate
+    budget and circuit breaker (weather/throttle.py) and raise Unavailable
+    right away when refused; each retry takes another call from the budget.
+    Transport errors and RETRY_STATUSES left after retries count as failures.
+    """
+    reason = throttle.admit(provider)
+    if reason:
+        raise Unavailable(_refused(provider, reason))
+    try:
+        response = session_for(provider).get(url, params=params, headers=headers, timeout=timeout_for(provider))
+    except requests.RequestException:
+        throttle.record(provider, ok=False)
+        raise
+    throttle.record(provider, ok=response.status_code not in RETRY_STATUSES)
+    return response
+
+
+def _build_async_client(provider: str):
+    return httpx.AsyncClient(
+        headers={"User-Agent": USER_AGENT},
+        timeout=httpx.Timeout(timeout_for(provider)[1], connect=settings.UPSTREAM_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=settings.UPSTREAM_POOL_MAXSIZE,
+            max_keepalive_connections=settings.UPSTREAM_POOL_MAXSIZE,
+        ),
+    )
+
+
+def async_client_for(provider: str) -> httpx.AsyncClient:
+    """
+    httpx pools are bound to the event loop that opened them, so clients are
+    kept per running loop (one for the lifetime of an ASGI server).
+    """
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.get(loop)
+    if clients is None:
+        clients = _async_clients[loop] = {}
+    client = clients.get(provider)
+    if client is None:
+        client = clients[provider] = _build_async_client(provider)
+    return client
+
+
+def _backoff(attempt: int, retry_after=None) -> float:
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), MAX_RETRY_AFTER)
+    delay = settings.UPSTREAM_BACKOFF_FACTOR * (2 ** attempt)
+    return delay + random.uniform(0, settings.UPSTREAM_BACKOFF_JITTER)
+
+
+async def aget(provider: str, url: str, params=None, headers=None):
+    reason = await throttle.aadmit(provider)
+    if reason:
+        raise AsyncUnavailable(_refused(provider, reason))
+    try:
+        response = await _aget_with_retries(provider, url, params, headers)
+    except httpx.TransportError:
+        await throttle.arecord(provider, ok=False)
+        raise
+    await throttle.arecord(provider, ok=response.status_code not in RETRY_STATUSES)
+    return response
+
+
+async def _aget_with_retries(provider: str, url: str, params=None, headers=None):
+    client = async_client_for(provider)
+    attempt = 0
+    while True:
+        try:
+            response = await client.get(url, params=params, headers=headers)
+        except httpx.TransportError:
+            if attempt >= settings.UPSTREAM_MAX_RETRIES:
+                raise
+            response = retry_after = None
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt >= settings.UPSTREAM_MAX_RETRIES:
+                return response
+            retry_after = response.headers.get("Retry-After")
+        await asyncio.sleep(_backoff(attempt, retry_after))
+        attempt += 1
+        if await throttle.aspend(provider):
+            # No budget left for the retry: settle for what the last attempt got.
+            if response is None:
+                raise AsyncUnavailable(_refused(provider, throttle.RATE))
+            return response
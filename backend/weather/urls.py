@@ -1,17 +1,20 @@
 from django.urls import path
 from rest_framework_simplejwt.views import TokenRefreshView
-from .views import alerts, weather_by_city, register, me, saved_locations, delete_saved_location, aqi, alerts, preferences, alert_subscriptions, delete_alert_subscription, news, google_auth
+from .views import alerts, weather_by_city, register, me, saved_locations, delete_saved_location, aqi, alerts, preferences, alert_subscriptions, delete_alert_subscription, news, google_auth, suggest, weather_batch, cache_stats, dashboard
 from .auth import EmailOrUsernameTokenView
 
 
 urlpatterns = [
     path("weather", weather_by_city),
+    path("weather/batch", weather_batch),
+    path("suggest", suggest),
 
     path("auth/register", register),
     path("auth/token", EmailOrUsernameTokenView.as_view(), name="token_obtain_pair"),
     path("auth/token/refresh", TokenRefreshView.as_view(), name="token_refresh"),
     path("auth/google", google_auth),
     path("me", me),
+    path("dashboard", dashboard),
     path("saved-locations", saved_locations),
     path("saved-locations/<int:pk>", delete_saved_location),
     path("alert-subscriptions", alert_subscriptions),
@@ -20,4 +23,5 @@ urlpatterns = [
     path("alerts", alerts),
     path("news", news),
     path("preferences", preferences),
+    path("cache/stats", cache_stats),
 ]
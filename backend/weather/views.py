@@ -1,93 +1,235 @@
-import time
+import asyncio
+import functools
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.decorators import api_view, permission_classes
 from django.contrib.auth.models import User
-from django.core.cache import cache
 from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+import httpx
 import requests
 from rest_framework_simplejwt.tokens import RefreshToken
 
 from .models import SavedLocation, UserPreference, AlertSubscription
-from .serializers import RegisterSerializer, SavedLocationSerializer, AlertSubscriptionSerializer
-from .services import geocode_city, geocode_address, reverse_geocode, fetch_forecast, fetch_aqi
-from .alerts import build_alerts
+from .serializers import RegisterSerializer, SavedLocationSerializer, AlertSubscriptionSerializer, BatchLocationSerializer, WeatherBatchSerializer
+from .airquality import aget_aqi
+from .forecasts import aget_forecast, get_forecasts, parse_projection, project
+from . import geocoding
+from . import suggest as suggestions
+from . import upstream
 from .pref_serializers import UserPreferenceSerializer
-from .cache_keys import weather_key, aqi_key, alerts_key
-
-_CACHE = {}
-CACHE_SECONDS = 600  # 10 minutes
-
-def _cache_get(key):
-    item = _CACHE.get(key)
-    if not item:
-        return None
-    expires_at, payload = item
-    if time.time() > expires_at:
-        _CACHE.pop(key, None)
-        return None
-    return payload
-
-def _cache_set(key, payload):
-    _CACHE[key] = (time.time() + CACHE_SECONDS, payload)
-
-@api_view(["GET"])
-@permission_classes([AllowAny])
-def weather_by_city(request):
-    city = (request.query_params.get("city") or "").strip()
-    lat = request.query_params.get("lat")
-    lon = request.query_params.get("lon")
-    timezone = request.query_params.get("timezone", "auto")
+from .cache_keys import body_key
+from . import admission
+from . import caching
+from . import codec
+from . import rendered
+from . import throttle
+from .caching import digest, response_headers, response_meta
+
+def _json(payload, status=200):
+    return JsonResponse(payload, status=status, json_dumps_params={"ensure_ascii": False, "separators": (",", ":")})
+
+async def _rendered(request, etag, body, info):
+    """
+    Pre-rendered response for `body()`: its JSON bytes and compressed copies
+    are cached under the ETag on first use, so later hits just pick the
+    encoding the client accepts and send the stored bytes without building
+    (or decoding) the body at all.
+    """
+    key = body_key(etag)
+    bodies = await caching.aread(key)
+    if bodies is None:
+        bodies = rendered.render(body())
+        await caching.awrite(key, bodies, max(info["max_age"], rendered.MIN_SECONDS))
+    encoding = rendered.negotiate(request.headers.get("Accept-Encoding"), bodies)
+    response = HttpResponse(bodies[encoding], content_type="application/json")
+    if encoding != "identity":
+        response["Content-Encoding"] = encoding
+    return response
+
+async def _conditional(request, info, body, *variant):
+    """
+    JSON response for a cached payload with ETag, Last-Modified and
+    Cache-Control set from the cache entry. max-age is the entry's whole
+    freshness lifetime and Age the seconds since it was fetched, so HTTP
+    caches count the elapsed time once. `body` is a function building the
+    response body, only called when the bytes are needed. The ETag combines
+    the payload digest with whatever else shapes the body (`variant`). A
+    matching If-None-Match (or, without one, an If-Modified-Since no older
+    than the fetch) gets a 304 and the body is never built. With
+    PRERENDERED_RESPONSES the body is served from _rendered and the cache
+    state only goes in headers; otherwise it is also merged into the body.
+    The ETag is weak since the bytes vary with Content-Encoding (and age).
+    """
+    etag = f'W/"{digest([info["digest"], *variant]) if variant else info["digest"]}"'
+    last_modified = int(info["fetched_at"])
+    headers = {
+        "ETag": etag,
+        "Last-Modified": http_date(last_modified),
+        "Cache-Control": f"public, max-age={info['lifetime']}",
+        **response_headers(info),
+    }
+
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        matched = if_none_match.strip() == "*" or etag.removeprefix("W/") in {
+            tag.removeprefix("W/") for tag in parse_etags(if_none_match)
+        }
+    else:
+        since = parse_http_date_safe(request.headers.get("If-Modified-Since") or "")
+        matched = since is not None and last_modified <= since
+    if matched:
+        response = HttpResponseNotModified()
+    elif settings.PRERENDERED_RESPONSES:
+        response = await _rendered(request, etag, body, info)
+    else:
+        response = _json({**body(), **response_meta(info)})
+    for name, value in headers.items():
+        response[name] = value
+    # On 304s too, so caches keep one validated copy per content coding.
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
+
+def async_get_view(view):
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD"):
+            return _json({"detail": f'Method "{request.method}" not allowed.'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+        try:
+            return await view(request, *args, **kwargs)
+        except httpx.HTTPError:
+            return _json({"detail": "Upstream request failed"}, status=status.HTTP_502_BAD_GATEWAY)
+        except admission.Overloaded as exc:
+            response = _json({"detail": "Service busy, try again shortly"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            response["Retry-After"] = str(exc.retry_after)
+            return response
+    return wrapper
+
+@async_get_view
+async def weather_by_city(request):
+    city = (request.GET.get("city") or "").strip()
+    lat = request.GET.get("lat")
+    lon = request.GET.get("lon")
+    timezone = request.GET.get("timezone", "auto")
     if not city and (lat is None or lon is None):
-        return Response({"detail": "city query param is required"}, status=status.HTTP_400_BAD_REQUEST)
+        return _json({"detail": "city query param is required"}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        projection = parse_projection(request.GET)
+    except ValueError as exc:
+        return _json({"detail": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
 
     if lat is not None and lon is not None:
         try:
             lat_f = float(lat)
             lon_f = float(lon)
         except ValueError:
-            return Response({"detail": "lat and lon must be numbers"}, status=status.HTTP_400_BAD_REQUEST)
-
-        key = weather_key(f"{lat_f}:{lon_f}:{timezone}")
-        cached = cache.get(key)
-        if cached:
-            cached["cached"] = True
-            return Response(cached)
-
-        forecast = fetch_forecast(lat_f, lon_f, timezone)
-        loc = reverse_geocode(lat_f, lon_f) or {
-            "name": city or "Current location",
-            "country": "",
-            "admin1": "",
-            "lat": lat_f,
-            "lon": lon_f,
-            "timezone": timezone,
-        }
-        payload = {"location": loc, "forecast": forecast, "cached": False}
-        cache.set(key, payload, timeout=600)
-        return Response(payload)
+            return _json({"detail": "lat and lon must be numbers"}, status=status.HTTP_400_BAD_REQUEST)
+
+        async def locate():
+            try:
+                place = await geocoding.areverse_geocode(lat_f, lon_f)
+            except httpx.HTTPError:
+                place = None
+            place = place or {"name": city or "Current location", "country": "", "admin1": ""}
+            # The place only names the point. The coordinates and timezone stay
+            # the ones the forecast is keyed on, so /api/alerts for this
+            # location reads the same cache entry.
+            return {
+                "name": place["name"],
+                "country": place["country"],
+                "admin1": place["admin1"],
+                "lat": lat_f,
+                "lon": lon_f,
+                "timezone": timezone,
+            }
+
+        loc, (entry, info) = await asyncio.gather(locate(), aget_forecast(lat_f, lon_f, timezone, projection, decode=False))
+        return await _conditional(request, info, lambda: {"location": loc, "forecast": entry()["forecast"]}, loc, projection)
+
+    loc = await geocoding.alocate(city)
+    if not loc:
+        return _json({"detail": "City not found"}, status=status.HTTP_404_NOT_FOUND)
 
-    key = weather_key(city)
+    entry, info = await aget_forecast(loc["lat"], loc["lon"], loc["timezone"], projection, decode=False)
+    return await _conditional(request, info, lambda: {"location": loc, "forecast": entry()["forecast"]}, loc, projection)
 
-    cached = cache.get(key)
-    if cached:
-        cached["cached"] = True
-        return Response(cached)
-    
-    loc = geocode_city(city)
-    if not loc:
-        loc = geocode_address(city)
-    if not loc:
-        return Response({"detail": "City not found"}, status=status.HTTP_404_NOT_FOUND)
+def _saved_location(loc):
+    return {
+        "name": loc.name,
+        "country": loc.country,
+        "admin1": loc.admin1,
+        "lat": loc.lat,
+        "lon": loc.lon,
+        "timezone": loc.timezone,
+    }
+
+@api_view(["POST"])
+@permission_classes([AllowAny])
+def weather_batch(request):
+    ser = WeatherBatchSerializer(data=request.data)
+    ser.is_valid(raise_exception=True)
+    ids = ser.validated_data["saved_location_ids"]
+    if ids and not request.user.is_authenticated:
+        return Response({"detail": "Authentication required for saved_location_ids"}, status=status.HTTP_401_UNAUTHORIZED)
+
+    items = []
+    if ids:
+        saved = {loc.id: loc for loc in SavedLocation.objects.filter(user=request.user, id__in=ids)}
+        for pk in ids:
+            loc = saved.get(pk)
+            if loc is None:
+                items.append({"id": pk, "location": None})
+                continue
+            items.append({"id": pk, "location": _saved_location(loc)})
+    for loc in ser.validated_data["locations"]:
+        items.append({"location": {"name": loc["name"], "country": "", "admin1": "", **loc}})
+
+    wanted = [item for item in items if item["location"] is not None]
+    try:
+        forecasts = get_forecasts([(i["location"]["lat"], i["location"]["lon"], i["location"]["timezone"]) for i in wanted])
+    except admission.Overloaded as exc:
+        return Response(
+            {"detail": "Service busy, try again shortly"},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={"Retry-After": str(exc.retry_after)},
+        )
+    for item, (entry, info) in zip(wanted, forecasts):
+        if entry is None:
+            item["detail"] = "Upstream request failed"
+        else:
+            item.update(forecast=entry["forecast"], **response_meta(info))
+    for item in items:
+        if item["location"] is None:
+            item["detail"] = "Not found"
+
+    return Response({"results": items})
 
-    forecast = fetch_forecast(loc["lat"], loc["lon"], loc["timezone"])
-    payload = {"location": loc, "forecast": forecast, "cached": False}
-    cache.set(key, payload, timeout=600)
+@api_view(["GET"])
+@permission_classes([AllowAny])
+def suggest(request):
+    query = (request.query_params.get("q") or "").strip()
+    try:
+        limit = max(1, min(int(request.query_params.get("limit", 5)), 10))
+    except ValueError:
+        limit = 5
+    if len(query) < 2:
+        return Response({"results": []})
+
+    places = suggestions.get_index().search(query, limit)
+    if not places:
+        # Only prefixes the index knows nothing about go upstream; their
+        # results are indexed, so the following keystrokes stay local.
+        try:
+            places = suggestions.search_upstream(query, limit)[:limit]
+        except requests.RequestException:
+            places = []
 
-    return Response(payload)
+    return Response({"results": suggestions.attach_current(places)})
 
 @api_view(["POST"])
 @permission_classes([AllowAny])
@@ -103,6 +245,71 @@ def me(request):
     u = request.user
     return Response({"id": u.id, "username": u.username, "email": u.email})
 
+# What the saved location cards and the compare view show.
+_SAVED_PREVIEW = {"fields": ("current", "hourly"), "hours": 6, "days": None}
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def dashboard(request):
+    """
+    Everything the frontend loads after login in one response: the user,
+    preferences, saved locations and alert subscriptions (one query each;
+    missing preferences come back as defaults without being created), plus
+    weather from one get_forecasts call (one cache read): the full forecast
+    and alerts for the active location (lat/lon/timezone/name params, else
+    the most recent saved location) and current conditions with the next
+    hours for each saved location.
+    """
+    user = request.user
+    active = None
+    if "lat" in request.query_params or "lon" in request.query_params:
+        ser = BatchLocationSerializer(data=request.query_params)
+        ser.is_valid(raise_exception=True)
+        active = {"name": ser.validated_data["name"], "country": "", "admin1": "", **ser.validated_data}
+
+    prefs = UserPreference.objects.filter(user=user).first() or UserPreference(user=user)
+    saved = list(SavedLocation.objects.filter(user=user).order_by("-created_at"))
+    subs = AlertSubscription.objects.filter(user=user).order_by("-created_at")
+
+    if active is None and saved:
+        active = _saved_location(saved[0])
+    located = saved[:WeatherBatchSerializer.MAX_LOCATIONS]
+    cells = [(loc.lat, loc.lon, loc.timezone) for loc in located]
+    if active is not None:
+        cells.insert(0, (active["lat"], active["lon"], active["timezone"]))
+    failed = "Upstream request failed"
+    try:
+        forecasts = get_forecasts(cells) if cells else []
+    except admission.Overloaded:
+        # The rest of the dashboard does not wait on upstream; the frontend
+        # fetches weather it did not get on its own.
+        forecasts = [(None, None)] * len(cells)
+        failed = "Service busy, try again shortly"
+
+    weather = {"active": None, "saved": []}
+    if active is not None:
+        entry, info = forecasts.pop(0)
+        weather["active"] = {"location": active}
+        if entry is None:
+            weather["active"]["detail"] = failed
+        else:
+            weather["active"].update(forecast=entry["forecast"], alerts=entry["alerts"], **response_meta(info))
+    for loc, (entry, info) in zip(located, forecasts):
+        item = {"id": loc.id}
+        if entry is None:
+            item["detail"] = failed
+        else:
+            item.update(forecast=project(entry["forecast"], _SAVED_PREVIEW), **response_meta(info))
+        weather["saved"].append(item)
+
+    return Response({
+        "me": {"id": user.id, "username": user.username, "email": user.email},
+        "preferences": UserPreferenceSerializer(prefs).data,
+        "saved_locations": SavedLocationSerializer(saved, many=True).data,
+        "alert_subscriptions": AlertSubscriptionSerializer(subs, many=True).data,
+        "weather": weather,
+    })
+
 @api_view(["GET", "POST"])
 @permission_classes([IsAuthenticated])
 def saved_locations(request):
@@ -149,10 +356,10 @@ def google_auth(request):
         return Response({"detail": "Google client is not configured"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
     try:
-        res = requests.get(
+        res = upstream.get(
+            upstream.GOOGLE,
             "https://oauth2.googleapis.com/tokeninfo",
             params={"id_token": token},
-            timeout=10,
         )
         res.raise_for_status()
         payload = res.json()
@@ -203,12 +410,13 @@ def news(request):
         return Response({"detail": "NEWS_API_KEY is not configured"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
     query = request.query_params.get("q") or settings.NEWS_QUERY
     cache_key = f"news:{query}"
-    cached = cache.get(cache_key)
+    cached = caching.read(cache_key)
     if cached:
         return Response(cached)
 
     try:
-        res = requests.get(
+        res = upstream.get(
+            upstream.NEWSAPI,
             "https://newsapi.org/v2/everything",
             params={
                 "q": query,
@@ -217,7 +425,6 @@ def news(request):
                 "language": "en",
                 "apiKey": settings.NEWS_API_KEY,
             },
-            timeout=10,
         )
         res.raise_for_status()
         data = res.json()
@@ -234,59 +441,38 @@ def news(request):
                 for a in articles
             ]
         }
-        cache.set(cache_key, payload, timeout=900)
+        caching.write(cache_key, payload, 900)
         return Response(payload)
     except requests.RequestException:
         return Response({"detail": "News request failed"}, status=status.HTTP_502_BAD_GATEWAY)
 
-@api_view(["GET"])
-@permission_classes([AllowAny])
-def aqi(request):
-    lat = request.query_params.get("lat")
-    lon = request.query_params.get("lon")
-    timezone = request.query_params.get("timezone", "auto")
+@async_get_view
+async def aqi(request):
+    lat = request.GET.get("lat")
+    lon = request.GET.get("lon")
+    timezone = request.GET.get("timezone", "auto")
 
     if lat is None or lon is None:
-        return Response({"detail": "lat and lon are required"}, status=status.HTTP_400_BAD_REQUEST)
-
-    lat_f = float(lat)
-    lon_f = float(lon)
-
-    key = aqi_key(lat_f, lon_f, timezone)
-    cached = cache.get(key)
-    if cached:
-        cached["cached"] = True
-        return Response(cached)
-
-    data = fetch_aqi(lat_f, lon_f, timezone)
-    payload = {"aqi": data, "cached": False}
-    cache.set(key, payload, timeout=900)
+        return _json({"detail": "lat and lon are required"}, status=status.HTTP_400_BAD_REQUEST)
 
-    return Response(payload)
+    payload, info = await aget_aqi(float(lat), float(lon), timezone, decode=False)
+    return await _conditional(request, info, payload)
 
-@api_view(["GET"])
-@permission_classes([AllowAny])
-def alerts(request):
-    lat = request.query_params.get("lat")
-    lon = request.query_params.get("lon")
-    timezone = request.query_params.get("timezone", "auto")
+@async_get_view
+async def alerts(request):
+    lat = request.GET.get("lat")
+    lon = request.GET.get("lon")
+    timezone = request.GET.get("timezone", "auto")
 
     if not lat or not lon:
-        return Response({"detail": "lat and lon are required"}, status=status.HTTP_400_BAD_REQUEST)
+        return _json({"detail": "lat and lon are required"}, status=status.HTTP_400_BAD_REQUEST)
 
     lat_f = float(lat)
     lon_f = float(lon)
 
-    key = alerts_key(lat_f, lon_f, timezone)
-    cached = cache.get(key)
-    if cached:
-        cached["cached"] = True
-        return Response(cached)
-
-    forecast = fetch_forecast(lat_f, lon_f, timezone)
-    payload = {"alerts": build_alerts(forecast), "cached": False}
-    cache.set(key, payload, timeout=600)
-    return Response(payload)
+    entry, info = await aget_forecast(lat_f, lon_f, timezone, decode=False)
+    # The alerts sit outside the series blocks, so those stay compressed.
+    return await _conditional(request, info, lambda: {"alerts": entry(series=False)["alerts"]}, "alerts")
 
 @api_view(["GET", "PUT"])
 @permission_classes([IsAuthenticated])
@@ -300,3 +486,18 @@ def preferences(request):
     ser.is_valid(raise_exception=True)
     ser.save()
     return Response(ser.data)
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def cache_stats(request):
+    """
+    Per-process cache counters: tier-1 (in-process LRU) and Redis hits/misses,
+    codec stats and this worker's admission limiter, plus the shared upstream
+    circuit/rate state.
+    """
+    return Response({
+        "tiers": caching.tier_stats(),
+        "codec": codec.stats(),
+        "admission": admission.limiter.snapshot(),
+        "upstream": throttle.status(),
+    })
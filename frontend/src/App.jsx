@@ -1,4 +1,4 @@
-import { useEffect, useMemo, useState } from "react";
+import { useEffect, useMemo, useRef, useState } from "react";
 import searchIcon from "./assets/search.svg";
 import locationIcon from "./assets/location.svg";
 import windIcon from "./assets/wind.svg";
@@ -314,6 +314,18 @@ function formatCacheTime(ts) {
   return new Date(ts).toLocaleString();
 }
 
+// Weather, AQI and alerts report their cache state in headers.
+function withCacheState(res, json) {
+  const state = res.headers.get("X-Cache");
+  if (!state || !json || typeof json !== "object" || Array.isArray(json)) return json;
+  return {
+    ...json,
+    cached: state !== "MISS",
+    stale: state === "STALE",
+    age: Number(res.headers.get("Age") || 0),
+  };
+}
+
 async function fetchJson(url) {
   const res = await fetch(url);
   const text = await res.text();
@@ -330,7 +342,7 @@ async function fetchJson(url) {
     err.body = json;
     throw err;
   }
-  return json;
+  return withCacheState(res, json);
 }
 
 export default function App() {
@@ -340,6 +352,7 @@ export default function App() {
   const [loadingWeather, setLoadingWeather] = useState(false);
   const [weatherErr, setWeatherErr] = useState("");
   const [weatherNotice, setWeatherNotice] = useState("");
+  const weatherLoaded = useRef(false);
   const [suggestions, setSuggestions] = useState([]);
   const [suggestLoading, setSuggestLoading] = useState(false);
   const [suggestErr, setSuggestErr] = useState("");
@@ -374,6 +387,7 @@ export default function App() {
   const [saved, setSaved] = useState([]);
   const [savedLoading, setSavedLoading] = useState(false);
   const [savedErr, setSavedErr] = useState("");
+  const [savedWeather, setSavedWeather] = useState({}); // saved location id -> dashboard weather preview
   const [compareIds, setCompareIds] = useState([]);
   const [compareData, setCompareData] = useState({});
   const [compareLoading, setCompareLoading] = useState(false);
@@ -400,6 +414,7 @@ export default function App() {
   );
 
   async function fetchWeather(cityName) {
+    weatherLoaded.current = true;
     setWeatherErr("");
     setWeatherNotice("");
     setLoadingWeather(true);
@@ -434,6 +449,7 @@ export default function App() {
   }
 
   async function fetchWeatherByCoords(lat, lon) {
+    weatherLoaded.current = true;
     setWeatherErr("");
     setWeatherNotice("");
     setLoadingWeather(true);
@@ -441,7 +457,7 @@ export default function App() {
     const key = `wp_cache_weather:${lat}:${lon}`;
     try {
       const res = await fetch(`${API_BASE}/weather?lat=${lat}&lon=${lon}`);
-      const json = await res.json();
+      const json = withCacheState(res, await res.json());
       if (!res.ok) throw new Error(json.detail || "Request failed");
       setData(json);
       cacheSet(key, json);
@@ -500,35 +516,12 @@ export default function App() {
       setSuggestLoading(true);
       setSuggestErr("");
       try {
-        const res = await fetch(
-          `https://geocoding-api.open-meteo.com/v1/search?name=${encodeURIComponent(
-            term
-          )}&count=5&language=en&format=json`,
-          { signal: controller.signal }
-        );
+        const res = await fetch(`${API_BASE}/suggest?q=${encodeURIComponent(term)}&limit=5`, {
+          signal: controller.signal,
+        });
+        if (!res.ok) throw new Error("Suggest request failed");
         const json = await res.json();
-        const results = json?.results || [];
-        const enriched = await Promise.allSettled(
-          results.map(async (r) => {
-            const forecastRes = await fetch(
-              `https://api.open-meteo.com/v1/forecast?latitude=${r.latitude}&longitude=${r.longitude}&current=temperature_2m,apparent_temperature&timezone=auto`,
-              { signal: controller.signal }
-            );
-            const forecastJson = await forecastRes.json();
-            const current = forecastJson?.current || {};
-            return {
-              id: `${r.latitude}:${r.longitude}`,
-              name: r.name,
-              country: r.country,
-              admin1: r.admin1,
-              temp: current.temperature_2m,
-              feels: current.apparent_temperature,
-            };
-          })
-        );
-        const list = enriched
-          .filter((r) => r.status === "fulfilled")
-          .map((r) => r.value);
+        const list = json?.results || [];
         setSuggestions(list);
       } catch (e) {
         if (e.name !== "AbortError") {
@@ -620,55 +613,66 @@ export default function App() {
   }
 
 
+  function seedWeather(active) {
+    // The dashboard response already holds the active location's forecast and alerts.
+    weatherLoaded.current = true;
+    const { alerts, ...json } = active;
+    setWeatherErr("");
+    setWeatherNotice("");
+    setCity(active.location.name);
+    setData(json);
+    cacheSet(`wp_cache_weather:${active.location.name.toLowerCase()}`, json);
+    setAlertsErr("");
+    setAlertsNotice("");
+    setAlertsData(alerts || []);
+    fetchAQIForLocation(active.location);
+  }
+
   async function loadMeAndSaved(tkn) {
     setSavedErr("");
     setSavedLoading(true);
     setAlertSubsErr("");
     setAlertSubsLoading(true);
-    let authFailed = false;
     try {
-      const meJson = await apiFetch("/me", { token: tkn });
-      setMe(meJson);
-      const prefJson = await apiFetch("/preferences", { token: tkn });
+      // One round trip for the user, preferences, saved locations, subscriptions and weather.
+      const dash = await apiFetch("/dashboard", { token: tkn });
+      setMe(dash.me);
+      const prefJson = dash.preferences;
       if (prefJson?.unit) setUnit(prefJson.unit);
       if (prefJson?.theme) setTheme(prefJson.theme);
       if (prefJson?.time_format) setTimeFormat(prefJson.time_format);
-
-
-      const savedJson = await apiFetch("/saved-locations", { token: tkn });
-      setSaved(savedJson);
+      setSaved(dash.saved_locations);
+      setAlertSubs(dash.alert_subscriptions);
+      const weather = dash.weather || {};
+      setSavedWeather(
+        Object.fromEntries((weather.saved || []).filter((item) => item.forecast).map((item) => [item.id, item]))
+      );
+      if (!weatherLoaded.current) {
+        if (weather.active?.forecast) seedWeather(weather.active);
+        else fetchWeather(city);
+      }
     } catch (e) {
       const msg = String(e?.message || "");
       setSavedErr(msg);
+      setAlertSubsErr(msg);
       setAuthErr(msg);
       setMe(null);
       setSaved([]);
-      authFailed = true;
+      setSavedWeather({});
+      if (!weatherLoaded.current) fetchWeather(city);
       if (msg.toLowerCase().includes("token") || msg.toLowerCase().includes("credential") || msg.toLowerCase().includes("auth")) {
         clearToken();
         setTokenState(null);
       }
     } finally {
       setSavedLoading(false);
-    }
-
-    if (!authFailed) {
-      try {
-        const subsJson = await apiFetch("/alert-subscriptions", { token: tkn });
-        setAlertSubs(subsJson);
-      } catch (e) {
-        setAlertSubsErr(e.message);
-      } finally {
-        setAlertSubsLoading(false);
-      }
-    } else {
       setAlertSubsLoading(false);
     }
   }
 
   useEffect(() => {
-    // initial weather load
-    fetchWeather(city);
+    // initial weather load; signed in, it comes with the dashboard instead
+    if (!token) fetchWeather(city);
     // eslint-disable-next-line react-hooks/exhaustive-deps
   }, []);
 
@@ -700,6 +704,7 @@ export default function App() {
     else {
       setMe(null);
       setSaved([]);
+      setSavedWeather({});
       setAlertSubs([]);
     }
   }, [token]);
@@ -712,19 +717,27 @@ export default function App() {
       return;
     }
     const selected = saved.filter((loc) => compareIds.includes(loc.id));
-    setCompareLoading(true);
+    // Locations the dashboard already sent weather for need no request.
+    const seeded = Object.fromEntries(
+      selected.filter((loc) => savedWeather[loc.id]).map((loc) => [loc.id, { loc, data: savedWeather[loc.id] }])
+    );
+    const missing = selected.filter((loc) => !savedWeather[loc.id]);
+    setCompareData(seeded);
     setCompareErr("");
-    Promise.all(
-      selected.map(async (loc) => {
-        const res = await fetch(`${API_BASE}/weather?city=${encodeURIComponent(loc.name)}`);
-        const json = await res.json();
-        if (!res.ok) throw new Error(json.detail || "Compare request failed");
-        return [loc.id, { loc, data: json }];
-      })
-    )
-      .then((entries) => {
+    setCompareLoading(missing.length > 0);
+    if (missing.length === 0) return;
+    apiFetch("/weather/batch", {
+      method: "POST",
+      token,
+      body: JSON.stringify({ saved_location_ids: missing.map((loc) => loc.id) }),
+    })
+      .then((json) => {
         if (!active) return;
-        setCompareData(Object.fromEntries(entries));
+        const byId = Object.fromEntries((json?.results || []).map((r) => [r.id, r]));
+        const entries = missing
+          .filter((loc) => byId[loc.id]?.forecast)
+          .map((loc) => [loc.id, { loc, data: byId[loc.id] }]);
+        setCompareData({ ...seeded, ...Object.fromEntries(entries) });
       })
       .catch((e) => {
         if (!active) return;
@@ -738,7 +751,7 @@ export default function App() {
     return () => {
       active = false;
     };
-  }, [compareIds, saved]);
+  }, [compareIds, saved, savedWeather, token]);
 
   async function onWeatherSearch(e) {
     e.preventDefault();
@@ -1482,6 +1495,8 @@ export default function App() {
                       <div className="text-xs text-subtle">
                         {loc.lat.toFixed(3)}, {loc.lon.toFixed(3)} • {loc.timezone} •{" "}
                         {formatLocalTime(loc.timezone) || "—"}
+                        {savedWeather[loc.id]?.forecast?.current &&
+                          ` • ${formatTemp(savedWeather[loc.id].forecast.current.temperature_2m)}`}
                       </div>
                     </button>
                     <button